@@ -0,0 +1,104 @@
+import argparse
+import re
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--command', dest='command', required=True)
+    parser.add_argument('--variants', dest='variants', required=True)
+    parser.add_argument('--runs', dest='runs', default='3', required=False)
+    parser.add_argument('--warmup-runs', dest='warmup_runs', default='1',
+                        required=False)
+    args = parser.parse_args()
+    return args
+
+
+def run_command(command):
+    """
+    Run one blueprint command and return how long it took, along with
+    everything it printed. A failed run stops the benchmark, since its
+    timing would be meaningless.
+    """
+    start_time = time.perf_counter()
+    result = subprocess.run(shlex.split(command), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    elapsed_time = time.perf_counter() - start_time
+    if result.returncode != 0:
+        print(result.stdout)
+        raise RuntimeError(f'{command} failed with exit code '
+                           f'{result.returncode}.')
+    return elapsed_time, result.stdout
+
+
+def find_row_count(output):
+    """
+    Return the last row count the blueprint printed, such as "Stored 100
+    rows" or "Loaded 100 rows". Loaders that handle several files print
+    their total last. Returns None if it didn't print any.
+    """
+    row_counts = re.findall(r'(?:Stored|Loaded|Extracted) (\d+) rows',
+                            output)
+    return int(row_counts[-1]) if row_counts else None
+
+
+def time_variant(command, runs=3, warmup_runs=1):
+    """
+    Run the command warmup_runs times without timing it, so caches on the
+    database and the local disk are warm for every variant, then time it
+    runs times.
+    """
+    for _ in range(warmup_runs):
+        run_command(command)
+    timings = []
+    row_count = None
+    for run in range(runs):
+        elapsed_time, output = run_command(command)
+        row_count = find_row_count(output)
+        print(f'Run {run + 1}: {elapsed_time:.2f} seconds.')
+        timings.append(elapsed_time)
+    return timings, row_count
+
+
+def print_results(results):
+    """
+    Print the median and best time of every variant, with rows/sec when the
+    blueprint reported how many rows it handled.
+    """
+    print(f'{"variant":<20}{"median (s)":>12}{"best (s)":>12}'
+          f'{"rows":>14}{"rows/sec":>14}')
+    for variant, (timings, row_count) in results.items():
+        median_time = statistics.median(timings)
+        rows_per_second = f'{row_count / median_time:.0f}' \
+            if row_count is not None else '-'
+        print(f'{variant:<20}{median_time:>12.2f}{min(timings):>12.2f}'
+              f'{row_count if row_count is not None else "-":>14}'
+              f'{rows_per_second:>14}')
+
+
+def main():
+    args = get_args()
+    command = args.command
+    variants = [variant.strip() for variant in args.variants.split(',')]
+    runs = int(args.runs)
+    warmup_runs = int(args.warmup_runs)
+
+    if '{variant}' not in command:
+        print('--command must contain {variant}, which is replaced by each '
+              'of the --variants in turn.')
+        sys.exit(1)
+
+    results = {}
+    for variant in variants:
+        print(f'Timing {variant}...')
+        results[variant] = time_variant(
+            command.replace('{variant}', variant), runs, warmup_runs)
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
+import re
 import time
+import random
 import argparse
 
 import boto3
+from botocore.exceptions import ClientError
 
 
 def get_args():
@@ -12,7 +15,14 @@ def get_args():
     parser.add_argument('--bucket', dest='bucket', required=True)
     parser.add_argument('--log-folder', dest='log_folder', required=False)
     parser.add_argument('--database', dest='database', required=False)
-    parser.add_argument('--query', dest='query', required=True)
+    parser.add_argument('--query', dest='query', required=False)
+    parser.add_argument('--query-file', dest='query_file', required=False)
+    parser.add_argument('--max-concurrent-queries',
+            dest='max_concurrent_queries', default='5', required=False)
+    parser.add_argument('--work-group', dest='work_group', default='',
+            required=False)
+    parser.add_argument('--query-timeout', dest='query_timeout', default='',
+            required=False)
     args = parser.parse_args()
     return args
 
@@ -28,13 +38,176 @@ def poll_status(client, job_id):
     state = result['QueryExecution']['Status']['State']
     if state == 'SUCCEEDED':
         print(f'Query completed')
-        return result
-    elif state == 'FAILED':
+    elif state in ('FAILED', 'CANCELLED'):
         error_msg = result['QueryExecution']['Status'].get('StateChangeReason')
-        print(f'Query failed')
+        print(f'Query {state.lower()}')
         print(error_msg)
-        return result
-    return False
+    return result
+
+
+def print_query_statistics(result):
+    '''
+    print where the query spent its time
+    '''
+    statistics = result['QueryExecution'].get('Statistics', {})
+    queue_time = statistics.get('QueryQueueTimeInMillis', 0) / 1000
+    planning_time = statistics.get('QueryPlanningTimeInMillis', 0) / 1000
+    engine_time = statistics.get('EngineExecutionTimeInMillis', 0) / 1000
+    total_time = statistics.get('TotalExecutionTimeInMillis', 0) / 1000
+    data_scanned = statistics.get('DataScannedInBytes', 0)
+    print(f'Queued for {queue_time:.2f}s, planned in {planning_time:.2f}s, '
+          f'executed by the engine in {engine_time:.2f}s '
+          f'({total_time:.2f}s total, {data_scanned} bytes scanned).')
+
+
+def get_next_delay(result, delay, max_delay=30):
+    '''
+    pick how long to wait before polling again
+    '''
+    # Back off exponentially, and let queries that have already run for a
+    # while wait proportionally longer, since they're likely to keep running.
+    statistics = result['QueryExecution'].get('Statistics', {})
+    engine_time = statistics.get('EngineExecutionTimeInMillis', 0) / 1000
+    delay = min(max(delay * 2, engine_time / 5), max_delay)
+    # Jitter keeps many waiters from polling the API in lockstep.
+    return random.uniform(delay / 2, delay)
+
+
+def wait_for_query(client, job_id, timeout=None, max_delay=30):
+    '''
+    wait for the query to finish, stopping it once timeout seconds pass
+    '''
+    start_time = time.time()
+    delay = 0.1
+    while True:
+        result = poll_status(client, job_id)
+        state = result['QueryExecution']['Status']['State']
+        if state in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+            print_query_statistics(result)
+            return result
+
+        if timeout and time.time() - start_time > timeout:
+            print(f'Query did not finish within {timeout} seconds. Stopping it.')
+            client.stop_query_execution(QueryExecutionId=job_id)
+            print_query_statistics(result)
+            raise TimeoutError(f'Query {job_id} timed out after {timeout} seconds')
+
+        delay = get_next_delay(result, delay, max_delay)
+        if timeout:
+            delay = min(delay, max(timeout - (time.time() - start_time), 0.1))
+        time.sleep(delay)
+
+
+def split_statements(queries):
+    """
+    Split text holding one or more statements on the semicolons between
+    them. Semicolons inside quoted strings are left alone.
+    """
+    parts = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", queries)
+    statements = ['']
+    for part in parts:
+        if part.startswith(("'", '"')):
+            statements[-1] += part
+            continue
+        pieces = part.split(';')
+        statements[-1] += pieces[0]
+        statements.extend(pieces[1:])
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def is_throttling_error(error):
+    """
+    Athena rejects new queries once the workgroup is running as many as it
+    allows, and the API throttles callers that poll too quickly.
+    """
+    return error.response.get('Error', {}).get('Code') in (
+        'TooManyRequestsException', 'ThrottlingException')
+
+
+def get_query_executions(client, job_ids):
+    """
+    Fetch the status of many queries at once, 50 at a time since that is
+    the most a single request accepts.
+    """
+    executions = []
+    for index in range(0, len(job_ids), 50):
+        response = client.batch_get_query_execution(
+            QueryExecutionIds=job_ids[index:index + 50])
+        executions.extend(response['QueryExecutions'])
+    return executions
+
+
+def print_query_summary(index, execution):
+    """
+    Print how one query of a batch finished and how long it took.
+    """
+    state = execution['Status']['State']
+    statistics = execution.get('Statistics', {})
+    total_time = statistics.get('TotalExecutionTimeInMillis', 0) / 1000
+    queue_time = statistics.get('QueryQueueTimeInMillis', 0) / 1000
+    engine_time = statistics.get('EngineExecutionTimeInMillis', 0) / 1000
+    data_scanned = statistics.get('DataScannedInBytes', 0)
+    print(f'Query {index + 1} {state.lower()} in {total_time:.2f}s '
+          f'(queued {queue_time:.2f}s, engine {engine_time:.2f}s, '
+          f'{data_scanned} bytes scanned).')
+    if state != 'SUCCEEDED':
+        print(execution['Status'].get('StateChangeReason'))
+
+
+def execute_queries(client, queries, job_parameters, max_concurrent_queries=5,
+                    timeout=None, max_delay=30):
+    """
+    Run every query, keeping up to max_concurrent_queries running at once,
+    and poll all running queries together in a single request. Queries the
+    workgroup has no room for yet are retried once others finish. Returns
+    the final execution of every query, in the order they were given.
+    """
+    pending = list(enumerate(queries))
+    running = {}
+    executions = [None] * len(queries)
+    delay = 0.1
+    while pending or running:
+        while pending and len(running) < max_concurrent_queries:
+            index, query = pending[0]
+            try:
+                job = client.start_query_execution(
+                    QueryString=query, **job_parameters)
+            except ClientError as e:
+                if not is_throttling_error(e):
+                    raise(e)
+                print('Athena is at its concurrency limit. Waiting to submit '
+                      f'the remaining {len(pending)} queries.')
+                break
+            pending.pop(0)
+            running[job['QueryExecutionId']] = (index, time.time())
+
+        delay = min(delay * 2, max_delay)
+        time.sleep(random.uniform(delay / 2, delay))
+        if not running:
+            continue
+
+        try:
+            running_executions = get_query_executions(client, list(running))
+        except ClientError as e:
+            if not is_throttling_error(e):
+                raise(e)
+            continue
+
+        for execution in running_executions:
+            job_id = execution['QueryExecutionId']
+            index, start_time = running[job_id]
+            state = execution['Status']['State']
+            if state in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+                print_query_summary(index, execution)
+                executions[index] = execution
+                del running[job_id]
+                # Something finished, so check back sooner.
+                delay = 0.1
+            elif timeout and time.time() - start_time > timeout:
+                print(f'Query {index + 1} did not finish within {timeout} '
+                      'seconds. Stopping it.')
+                client.stop_query_execution(QueryExecutionId=job_id)
+    return executions
 
 
 def main():
@@ -46,6 +219,17 @@ def main():
     bucket = args.bucket
     log_folder = args.log_folder
     query = args.query
+    query_file = args.query_file
+    query_timeout = float(args.query_timeout) if args.query_timeout else None
+    max_concurrent_queries = int(args.max_concurrent_queries)
+    work_group = args.work_group
+
+    if query_file:
+        with open(query_file, 'r') as queries:
+            query = queries.read()
+    if not query:
+        raise ValueError('Either --query or --query-file must be provided.')
+    queries = split_statements(query)
 
     try:
         client = boto3.client('athena', region_name=region_name,
@@ -65,20 +249,42 @@ def main():
     else:
         output = f's3://{bucket}/'
 
+    job_parameters = dict(
+        QueryExecutionContext=context,
+        ResultConfiguration={'OutputLocation': output})
+    if work_group:
+        job_parameters['WorkGroup'] = work_group
+
+    if len(queries) > 1:
+        start_time = time.time()
+        executions = execute_queries(
+            client, queries, job_parameters,
+            max_concurrent_queries=max_concurrent_queries,
+            timeout=query_timeout)
+        failed_count = sum(
+            1 for execution in executions
+            if execution['Status']['State'] != 'SUCCEEDED')
+        data_scanned = sum(
+            execution.get('Statistics', {}).get('DataScannedInBytes', 0)
+            for execution in executions)
+        print(f'Ran {len(queries)} queries in {time.time() - start_time:.2f}s, '
+              f'scanning {data_scanned} bytes.')
+        if failed_count:
+            raise RuntimeError(f'{failed_count} of {len(queries)} queries '
+                               'did not succeed.')
+        print('Your queries have been successfully executed.')
+        return
+
     job = client.start_query_execution(
-                QueryString=query,
-                QueryExecutionContext=context,
-                ResultConfiguration={'OutputLocation': output}
+                QueryString=queries[0],
+                **job_parameters
                 )
 
     job_id = job['QueryExecutionId']
 
-    status = poll_status(client, job_id)
-    while not status:
-        time.sleep(5)
-        status = poll_status(client, job_id)
+    status = wait_for_query(client, job_id, timeout=query_timeout)
 
-    if status['QueryExecution']['Status']['State'] != 'FAILED':
+    if status['QueryExecution']['Status']['State'] == 'SUCCEEDED':
         print('Your query has been successfully executed.')
 
 
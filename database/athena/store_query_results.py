@@ -1,8 +1,17 @@
 import os
+import re
+import json
 import time
+import hashlib
+import uuid
+import random
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.exceptions import ClientError
+import pyarrow.parquet as pq
 
 
 def get_args():
@@ -14,10 +23,29 @@ def get_args():
     parser.add_argument('--log-folder', dest='log_folder', required=False)
     parser.add_argument('--database', dest='database', required=False)
     parser.add_argument('--query', dest='query', required=True)
+    parser.add_argument('--query-timeout', dest='query_timeout', default='',
+            required=False)
     parser.add_argument('--destination-file-name', dest='destination_file_name',
             default='output.csv', required=True)
     parser.add_argument('--destination-folder-name',
             dest='destination_folder_name', default='', required=False)
+    parser.add_argument('--export-method', dest='export_method',
+            choices={'csv', 'unload'}, default='csv', required=False)
+    parser.add_argument('--destination-file-format',
+            dest='destination_file_format', choices={'csv', 'parquet'},
+            default='csv', required=False)
+    parser.add_argument('--merge-files', dest='merge_files', default='True',
+            required=False)
+    parser.add_argument('--max-workers', dest='max_workers', default='8',
+            required=False)
+    parser.add_argument('--work-group', dest='work_group', default='',
+            required=False)
+    parser.add_argument('--use-cache', dest='use_cache', default='False',
+            required=False)
+    parser.add_argument('--cache-max-age', dest='cache_max_age',
+            default='3600', required=False)
+    parser.add_argument('--cache-file-name', dest='cache_file_name',
+            default='athena_query_cache.json', required=False)
     args = parser.parse_args()
     return args
 
@@ -44,12 +72,34 @@ def combine_folder_and_file_name(folder_name, file_name):
     return combined_name
 
 
-def create_csv(job_id, bucket, s3_client, destination_file_path):
+def split_s3_url(s3_url):
+    """
+    Split an s3:// url into its bucket name and key.
+    """
+    bucket_name, _, key = s3_url[len('s3://'):].partition('/')
+    return bucket_name, key
+
+
+def enumerate_destination_file_name(destination_full_path, file_number=1):
+    """
+    Append a number to the end of the provided destination file name.
+    Used to name the part files written by UNLOAD.
+    """
+    folder_name, file_name = os.path.split(destination_full_path)
+    if re.search(r'\.', file_name):
+        file_name = re.sub(r'\.', f'_{file_number}.', file_name, 1)
+    else:
+        file_name = f'{file_name}_{file_number}'
+    return os.path.join(folder_name, file_name)
+
+
+def create_csv(output_location, s3_client, destination_file_path):
     """
     Read in data from an Athena query. Store the data as a csv.
     """
+    bucket, key = split_s3_url(output_location)
     try:
-        response = s3_client.Bucket(bucket).download_file(f'{job_id}.csv',
+        response = s3_client.Bucket(bucket).download_file(key,
                                                     destination_file_path)
     except Exception as e:
         print(f'Failed to download query results to {destination_file_path}')
@@ -57,6 +107,184 @@ def create_csv(job_id, bucket, s3_client, destination_file_path):
     print(f'Successfully downloaded query results to {destination_file_path}')
 
 
+def create_unload_query(query, unload_location):
+    """
+    Wrap the query in an UNLOAD statement, so Athena writes the results as
+    snappy compressed parquet files, in parallel, instead of one csv.
+    """
+    query = query.strip().rstrip(';')
+    return (f"UNLOAD ({query}) TO '{unload_location}' "
+            "WITH (format = 'PARQUET', compression = 'SNAPPY')")
+
+
+def download_unload_files(s3_client, unload_location, download_folder,
+                          max_workers=8):
+    """
+    Download every part file UNLOAD wrote, several at a time. Returns the
+    local paths in the same order as the keys on S3.
+    """
+    bucket, prefix = split_s3_url(unload_location)
+    keys = sorted(obj.key for obj in s3_client.Bucket(bucket).objects.filter(
+        Prefix=prefix) if not obj.key.endswith('/'))
+    file_paths = [
+        os.path.join(download_folder, f'part_{index}.parquet')
+        for index in range(len(keys))]
+
+    # Resources aren't thread safe, but the client underneath them is.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(s3_client.meta.client.download_file, bucket, key,
+                            file_path)
+            for key, file_path in zip(keys, file_paths)]
+        for future in futures:
+            future.result()
+    print(f'Downloaded {len(file_paths)} files from {unload_location}')
+    return file_paths
+
+
+def write_parquet_files(source_file_paths, destination_file_path,
+                        destination_file_format='csv'):
+    """
+    Write the row groups of every source parquet file, in order, into one
+    csv or parquet file. Only one row group is held in memory at a time.
+    Returns the number of rows written.
+    """
+    writer = None
+    row_count = 0
+    try:
+        for source_file_path in source_file_paths:
+            parquet_file = pq.ParquetFile(source_file_path)
+            for index in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(index)
+                if destination_file_format == 'parquet':
+                    if not writer:
+                        writer = pq.ParquetWriter(destination_file_path,
+                                                  table.schema,
+                                                  compression='snappy')
+                    writer.write_table(table)
+                else:
+                    if not writer:
+                        writer = open(destination_file_path, 'w', newline='')
+                    table.to_pandas().to_csv(writer, index=False,
+                                             header=row_count == 0)
+                row_count += table.num_rows
+    finally:
+        if writer:
+            writer.close()
+    return row_count
+
+
+def create_files_with_unload(unload_location, s3_client,
+                             destination_full_path,
+                             destination_file_format='csv', merge_files=True,
+                             max_workers=8):
+    """
+    Download the part files of an UNLOAD and either merge them into one
+    local csv or parquet file, or keep one local file per part.
+    """
+    download_folder = tempfile.mkdtemp(
+        dir=os.path.dirname(destination_full_path) or None)
+    try:
+        file_paths = download_unload_files(
+            s3_client, unload_location, download_folder, max_workers)
+        if merge_files:
+            row_count = write_parquet_files(
+                file_paths, destination_full_path, destination_file_format)
+            print(f'{destination_full_path} was successfully created with '
+                  f'{row_count} rows.')
+            return
+
+        for index, file_path in enumerate(file_paths):
+            part_file_path = enumerate_destination_file_name(
+                destination_full_path, index + 1)
+            if destination_file_format == 'parquet':
+                os.replace(file_path, part_file_path)
+            else:
+                write_parquet_files([file_path], part_file_path, 'csv')
+            print(f'{part_file_path} was successfully created.')
+    finally:
+        for file_name in os.listdir(download_folder):
+            os.remove(os.path.join(download_folder, file_name))
+        os.rmdir(download_folder)
+
+
+def normalize_query(query):
+    """
+    Collapse whitespace and drop any trailing semicolon, so formatting
+    changes don't stop a query from matching the cache. Quoted strings are
+    left exactly as they are.
+    """
+    parts = re.split(r"('(?:[^']|'')*')", query.strip().rstrip(';'))
+    return ''.join(
+        part if part.startswith("'") else re.sub(r'\s+', ' ', part)
+        for part in parts).strip()
+
+
+def create_cache_key(query, database, work_group, export_method):
+    """
+    Key a cached result on everything that changes what the query returns
+    or where its results are written.
+    """
+    key = json.dumps([normalize_query(query), database or '', work_group or '',
+                      export_method])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def read_cache(cache_file_name):
+    """
+    Read the cache file, starting a new one if it doesn't exist yet.
+    """
+    if not os.path.exists(cache_file_name):
+        return {'hits': 0, 'misses': 0, 'queries': {}}
+    with open(cache_file_name, 'r') as cache_file:
+        return json.load(cache_file)
+
+
+def write_cache(cache, cache_file_name):
+    """
+    Replace the cache file in one step, so an interrupted run can't leave
+    it half written.
+    """
+    temporary_file_name = f'{cache_file_name}.tmp'
+    with open(temporary_file_name, 'w') as cache_file:
+        json.dump(cache, cache_file, indent=2)
+    os.replace(temporary_file_name, cache_file_name)
+
+
+def results_exist(s3_client, result_location, export_method='csv'):
+    """
+    Check that the results of a cached query are still on S3, since they
+    may have been removed by a lifecycle rule since the query ran.
+    """
+    bucket, key = split_s3_url(result_location)
+    if export_method == 'unload':
+        return any(True for _ in s3_client.Bucket(bucket).objects.filter(
+            Prefix=key).limit(1))
+    try:
+        s3_client.Object(bucket, key).load()
+    except ClientError:
+        return False
+    return True
+
+
+def find_cached_result(cache, cache_key, client, s3_client, cache_max_age,
+                       export_method='csv'):
+    """
+    Return the results location of a previous run of the same query if it
+    finished within cache_max_age seconds and its results are still on S3.
+    """
+    entry = cache['queries'].get(cache_key)
+    if not entry or time.time() - entry['completed_at'] > cache_max_age:
+        return None
+    result = client.get_query_execution(
+        QueryExecutionId=entry['query_execution_id'])
+    if result['QueryExecution']['Status']['State'] != 'SUCCEEDED':
+        return None
+    if not results_exist(s3_client, entry['result_location'], export_method):
+        return None
+    return entry
+
+
 def poll_status(client, job_id):
     '''
     poll query status
@@ -68,13 +296,64 @@ def poll_status(client, job_id):
     state = result['QueryExecution']['Status']['State']
     if state == 'SUCCEEDED':
         print(f'Query completed')
-        return result
-    elif state == 'FAILED':
+    elif state in ('FAILED', 'CANCELLED'):
         error_msg = result['QueryExecution']['Status'].get('StateChangeReason')
-        print(f'Query failed')
+        print(f'Query {state.lower()}')
         print(error_msg)
-        return result
-    return False
+    return result
+
+
+def print_query_statistics(result):
+    '''
+    print where the query spent its time
+    '''
+    statistics = result['QueryExecution'].get('Statistics', {})
+    queue_time = statistics.get('QueryQueueTimeInMillis', 0) / 1000
+    planning_time = statistics.get('QueryPlanningTimeInMillis', 0) / 1000
+    engine_time = statistics.get('EngineExecutionTimeInMillis', 0) / 1000
+    total_time = statistics.get('TotalExecutionTimeInMillis', 0) / 1000
+    data_scanned = statistics.get('DataScannedInBytes', 0)
+    print(f'Queued for {queue_time:.2f}s, planned in {planning_time:.2f}s, '
+          f'executed by the engine in {engine_time:.2f}s '
+          f'({total_time:.2f}s total, {data_scanned} bytes scanned).')
+
+
+def get_next_delay(result, delay, max_delay=30):
+    '''
+    pick how long to wait before polling again
+    '''
+    # Back off exponentially, and let queries that have already run for a
+    # while wait proportionally longer, since they're likely to keep running.
+    statistics = result['QueryExecution'].get('Statistics', {})
+    engine_time = statistics.get('EngineExecutionTimeInMillis', 0) / 1000
+    delay = min(max(delay * 2, engine_time / 5), max_delay)
+    # Jitter keeps many waiters from polling the API in lockstep.
+    return random.uniform(delay / 2, delay)
+
+
+def wait_for_query(client, job_id, timeout=None, max_delay=30):
+    '''
+    wait for the query to finish, stopping it once timeout seconds pass
+    '''
+    start_time = time.time()
+    delay = 0.1
+    while True:
+        result = poll_status(client, job_id)
+        state = result['QueryExecution']['Status']['State']
+        if state in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+            print_query_statistics(result)
+            return result
+
+        if timeout and time.time() - start_time > timeout:
+            print(f'Query did not finish within {timeout} seconds. Stopping it.')
+            client.stop_query_execution(QueryExecutionId=job_id)
+            print_query_statistics(result)
+            raise TimeoutError(f'Query {job_id} timed out after {timeout} seconds')
+
+        delay = get_next_delay(result, delay, max_delay)
+        if timeout:
+            delay = min(delay, max(timeout - (time.time() - start_time), 0.1))
+        time.sleep(delay)
 
 
 def main():
@@ -86,6 +365,15 @@ def main():
     bucket = args.bucket
     log_folder = args.log_folder
     query = args.query
+    query_timeout = float(args.query_timeout) if args.query_timeout else None
+    export_method = args.export_method
+    destination_file_format = args.destination_file_format
+    merge_files = convert_to_boolean(args.merge_files)
+    max_workers = int(args.max_workers)
+    work_group = args.work_group
+    use_cache = convert_to_boolean(args.use_cache)
+    cache_max_age = float(args.cache_max_age)
+    cache_file_name = args.cache_file_name
     destination_file_name = args.destination_file_name
     destination_folder_name = args.destination_folder_name
     destination_full_path = combine_folder_and_file_name(
@@ -120,24 +408,71 @@ def main():
     else:
         output = f's3://{bucket}/'
 
-    job = client.start_query_execution(
-                QueryString=query,
-                QueryExecutionContext=context,
-                ResultConfiguration={'OutputLocation': output}
-                )
+    if use_cache:
+        cache = read_cache(cache_file_name)
+        cache_key = create_cache_key(query, database, work_group, export_method)
+        cached_result = find_cached_result(
+            cache, cache_key, client, s3_client, cache_max_age, export_method)
+        if cached_result:
+            cache['hits'] += 1
+        else:
+            cache['misses'] += 1
+        print(f'Cache {"hit" if cached_result else "miss"}. '
+              f'{cache["hits"]} hits and {cache["misses"]} misses so far.')
+    else:
+        cached_result = None
+
+    if cached_result:
+        job_id = cached_result['query_execution_id']
+        result_location = cached_result['result_location']
+        print(f'Reusing the results of query {job_id}.')
+    else:
+        if export_method == 'unload':
+            # UNLOAD needs an empty location, so every run gets its own.
+            unload_location = f'{output}unload/{uuid.uuid4()}/'
+            query = create_unload_query(query, unload_location)
 
-    job_id = job['QueryExecutionId']
+        job_parameters = dict(
+            QueryString=query,
+            QueryExecutionContext=context,
+            ResultConfiguration={'OutputLocation': output})
+        if work_group:
+            job_parameters['WorkGroup'] = work_group
+        job = client.start_query_execution(**job_parameters)
 
-    status = poll_status(client, job_id)
-    while not status:
-        time.sleep(5)
-        status = poll_status(client, job_id)
+        job_id = job['QueryExecutionId']
 
-    create_csv(
-        job_id=job_id,
-        bucket=bucket,
-        s3_client=s3_client,
-        destination_file_path=destination_full_path)
+        status = wait_for_query(client, job_id, timeout=query_timeout)
+        state = status['QueryExecution']['Status']['State']
+        if state != 'SUCCEEDED':
+            raise RuntimeError(f'Query {job_id} finished as {state}')
+
+        if export_method == 'unload':
+            result_location = unload_location
+        else:
+            result_location = status['QueryExecution']['ResultConfiguration']['OutputLocation']
+
+    if use_cache:
+        if not cached_result:
+            cache['queries'][cache_key] = {
+                'query_execution_id': job_id,
+                'result_location': result_location,
+                'completed_at': time.time()}
+        write_cache(cache, cache_file_name)
+
+    if export_method == 'unload':
+        create_files_with_unload(
+            unload_location=result_location,
+            s3_client=s3_client,
+            destination_full_path=destination_full_path,
+            destination_file_format=destination_file_format,
+            merge_files=merge_files,
+            max_workers=max_workers)
+    else:
+        create_csv(
+            output_location=result_location,
+            s3_client=s3_client,
+            destination_file_path=destination_full_path)
 
 
 if __name__ == '__main__':
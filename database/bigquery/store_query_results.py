@@ -1,11 +1,27 @@
+import io
 import os
+import re
+import bz2
+import gzip
 import json
+import queue
 import tempfile
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import zstandard
 
 from google.cloud import bigquery
 from google.oauth2 import service_account
 from google.api_core.exceptions import NotFound
+try:
+    from google.cloud import bigquery_storage_v1
+except ImportError:
+    bigquery_storage_v1 = None
 
 
 def get_args():
@@ -16,10 +32,48 @@ def get_args():
             default='output.csv', required=True)
     parser.add_argument('--destination-folder-name',
             dest='destination_folder_name', default='', required=False)
+    parser.add_argument('--destination-file-format',
+            dest='destination_file_format',
+            choices={'csv', 'parquet'}, default='csv',
+            required=False)
+    parser.add_argument('--parquet-compression', dest='parquet_compression',
+            choices={'snappy', 'gzip', 'brotli', 'zstd', 'none'},
+            default='snappy', required=False)
+    parser.add_argument('--row-group-size', dest='row_group_size',
+            default='10000', required=False)
+    parser.add_argument('--compression', dest='compression',
+            choices={'none', 'gzip', 'zstd', 'bz2'}, default='none',
+            required=False)
+    parser.add_argument('--export-method', dest='export_method',
+            choices={'pandas', 'storage_api'}, default='pandas',
+            required=False)
+    parser.add_argument('--max-streams', dest='max_streams', default='4',
+            required=False)
+    parser.add_argument('--max-queued-pages', dest='max_queued_pages',
+            default='16', required=False)
+    parser.add_argument('--merge-files', dest='merge_files', default='True',
+            required=False)
     args = parser.parse_args()
     return args
 
 
+BIGQUERY_TYPES = {
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'NUMERIC': pa.decimal128(38, 9),
+    'BOOLEAN': pa.bool_(),
+    'BOOL': pa.bool_(),
+    'STRING': pa.string(),
+    'BYTES': pa.binary(),
+    'DATE': pa.date32(),
+    'DATETIME': pa.timestamp('us'),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    'TIME': pa.time64('us'),
+}
+
+
 def set_environment_variables(args):
     """
     Set GCP credentials as environment variables if they're provided via keyword
@@ -41,6 +95,18 @@ def set_environment_variables(args):
         return
 
 
+def convert_to_boolean(string):
+    """
+    Shipyard can't support passing Booleans to code, so we have to convert
+    string values to their boolean values.
+    """
+    if string in ['True', 'true', 'TRUE']:
+        value = True
+    else:
+        value = False
+    return value
+
+
 def combine_folder_and_file_name(folder_name, file_name):
     """
     Combine together the provided folder_name and file_name into one path variable.
@@ -51,7 +117,67 @@ def combine_folder_and_file_name(folder_name, file_name):
     return combined_name
 
 
-def create_csv(query, client, destination_file_path):
+def enumerate_destination_file_name(destination_full_path, file_number=1):
+    """
+    Append a number to the end of the provided destination file name.
+    Used to name the part files written by each read stream.
+    """
+    folder_name, file_name = os.path.split(destination_full_path)
+    if re.search(r'\.', file_name):
+        file_name = re.sub(r'\.', f'_{file_number}.', file_name, 1)
+    else:
+        file_name = f'{file_name}_{file_number}'
+    return os.path.join(folder_name, file_name)
+
+
+def add_compression_extension(destination_full_path, compression):
+    """
+    Add the file extension matching the compression method, unless the
+    provided file name already ends with it.
+    """
+    extension = {'gzip': '.gz', 'bz2': '.bz2', 'zstd': '.zst'}.get(compression)
+    if extension and not destination_full_path.endswith(extension):
+        destination_full_path = f'{destination_full_path}{extension}'
+    return destination_full_path
+
+
+def open_destination_file(destination_file_path, compression='none',
+                          buffer_size=8388608):
+    """
+    Open the destination file once for the whole extract, with a large write
+    buffer. Rows are compressed as they are written when a compression
+    method is provided, so the uncompressed file never touches disk. Any
+    file left behind by a previous run is truncated rather than appended to.
+    """
+    if compression == 'gzip':
+        binary_file = gzip.open(destination_file_path, 'wb')
+    elif compression == 'bz2':
+        binary_file = bz2.open(destination_file_path, 'wb')
+    elif compression == 'zstd':
+        # threads=-1 spreads compression across every available core.
+        binary_file = zstandard.ZstdCompressor(threads=-1).stream_writer(
+            open(destination_file_path, 'wb', buffering=buffer_size))
+    else:
+        binary_file = open(destination_file_path, 'wb', buffering=buffer_size)
+    return io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+
+
+def close_destination_file(destination_file, destination_file_path):
+    """
+    Close the destination file, writing out any buffered or compressed data,
+    and fsync it once every row has been written. Returns the number of
+    bytes written.
+    """
+    destination_file.close()
+    file_descriptor = os.open(destination_file_path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+    return os.path.getsize(destination_file_path)
+
+
+def create_csv(query, client, destination_file_path, compression='none'):
     """
     Read in data from a SQL query. Store the data as a csv.
     """
@@ -62,7 +188,10 @@ def create_csv(query, client, destination_file_path):
         raise(e)
 
     try:
-        data.to_csv(destination_file_path)
+        destination_file = open_destination_file(
+            destination_file_path, compression)
+        data.to_csv(destination_file)
+        close_destination_file(destination_file, destination_file_path)
     except Exception as e:
         print(f'Failed to write the data to csv {destination_file_path}')
         raise(e)
@@ -84,11 +213,500 @@ def get_client(credentials):
         raise(e)
 
 
+def promote_arrow_types(field_types):
+    """
+    Pick one type that values of every type in field_types can be stored as.
+    Nulls take the type of the other values, integers mixed with floats
+    become floats and decimals are widened to fit every precision and
+    scale. Any other mix is stored as strings. Columns with nothing but
+    nulls stay null, so a later chunk can still give them a real type.
+    """
+    field_types = [field_type for field_type in field_types
+                   if field_type != pa.null()]
+    if not field_types:
+        return pa.null()
+    if all(field_type == field_types[0] for field_type in field_types):
+        return field_types[0]
+    if all(pa.types.is_integer(field_type) for field_type in field_types):
+        return pa.int64()
+    if all(pa.types.is_integer(field_type) or pa.types.is_floating(field_type)
+           for field_type in field_types):
+        return pa.float64()
+    if all(pa.types.is_decimal(field_type) for field_type in field_types):
+        scale = max(field_type.scale for field_type in field_types)
+        integer_digits = max(field_type.precision - field_type.scale
+                             for field_type in field_types)
+        return pa.decimal128(min(integer_digits + scale, 38), scale)
+    return pa.string()
+
+
+def promote_schemas(schemas):
+    """
+    Build one schema that tables with every schema in schemas can be cast
+    to. Fields are kept in the order of the first schema.
+    """
+    field_types = [dict(zip(schema.names, schema.types))
+                   for schema in schemas]
+    return pa.schema([
+        pa.field(field_name, promote_arrow_types(
+            [types[field_name] for types in field_types
+             if field_name in types]))
+        for field_name in schemas[0].names])
+
+
+def create_merged_schema(file_paths):
+    """
+    Build one schema that every parquet file in file_paths can be cast to,
+    rather than assuming the types of the first file hold for all of them.
+    """
+    return promote_schemas(
+        [pq.read_schema(file_path) for file_path in file_paths])
+
+
+def cast_table(table, schema):
+    """
+    Cast every column of the table to the type in the schema. Columns that
+    Arrow can't cast directly are converted through their Python values.
+    """
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if column.type != field.type:
+            try:
+                column = column.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                values = column.to_pylist()
+                if field.type == pa.string():
+                    values = [None if value is None else str(value)
+                              for value in values]
+                column = pa.array(values, type=field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def widen_parquet_file(writer, destination_file_path, schema, compression):
+    """
+    Rewrite the row groups already written to destination_file_path with
+    the wider schema, then return a writer that appends with that schema.
+    Parquet files have one schema, so this is the only way to widen a
+    column after its first row group.
+    """
+    writer.close()
+    previous_file_path = f'{destination_file_path}.tmp'
+    os.replace(destination_file_path, previous_file_path)
+    previous_file = pq.ParquetFile(previous_file_path)
+    writer = pq.ParquetWriter(destination_file_path, schema,
+                              compression=compression)
+    for row_group in range(previous_file.num_row_groups):
+        writer.write_table(cast_table(
+            previous_file.read_row_group(row_group), schema))
+    os.remove(previous_file_path)
+    return writer
+
+
+def write_parquet_chunk(writer, schema, table, destination_file_path,
+                        compression='snappy', row_group_size=10000):
+    """
+    Write one chunk of results to the parquet file, opening the writer on
+    the first chunk. The first chunk can't know every type, since a column
+    can be null or hold narrower decimals until later, so the schema is
+    widened whenever a chunk doesn't fit it. Returns the writer and the
+    schema to pass along with the next chunk.
+    """
+    if not writer:
+        schema = promote_schemas([table.schema])
+        writer = pq.ParquetWriter(destination_file_path, schema,
+                                  compression=compression)
+    else:
+        wider_schema = promote_schemas([schema, table.schema])
+        if not wider_schema.equals(schema):
+            schema = wider_schema
+            writer = widen_parquet_file(writer, destination_file_path,
+                                        schema, compression)
+    writer.write_table(cast_table(table, schema),
+                       row_group_size=row_group_size)
+    return writer, schema
+
+
+def create_parquet(query, client, destination_file_path, row_group_size=10000,
+                   compression='snappy'):
+    """
+    Read in data from a SQL query one page at a time. Store the data as a
+    parquet file, writing each page as its own row group so the full result
+    is never held in memory.
+    """
+    try:
+        rows = client.query(query).result(page_size=row_group_size)
+    except Exception as e:
+        print(f'Failed to execute your query: {query}')
+        raise(e)
+
+    column_names = [field.name for field in rows.schema]
+    writer = None
+    schema = None
+    try:
+        for page in rows.pages:
+            chunk = pd.DataFrame.from_records(
+                [row.values() for row in page], columns=column_names)
+            writer, schema = write_parquet_chunk(
+                writer, schema,
+                pa.Table.from_pandas(chunk, preserve_index=False),
+                destination_file_path, compression, row_group_size)
+    except Exception as e:
+        print(f'Failed to write the data to parquet {destination_file_path}')
+        raise(e)
+    finally:
+        if writer:
+            writer.close()
+
+    print(f'Successfully stored query results to {destination_file_path}')
+
+
+def create_arrow_schema(schema):
+    """
+    Columns that are entirely null in the first page have no usable type
+    yet, so they are stored as strings. Every later page is cast to this
+    schema so the whole file has one stable set of types.
+    """
+    return pa.schema([
+        pa.field(field.name, pa.string()) if field.type == pa.null() else field
+        for field in schema])
+
+
+def create_bigquery_schema(fields):
+    """
+    Map the BigQuery column types to Arrow types, so every page is written
+    with the same types no matter which values it happens to hold.
+    Repeated and nested columns, and any type without a match, are stored
+    as strings.
+    """
+    return pa.schema([
+        pa.field(field.name, pa.string() if field.mode == 'REPEATED'
+                 else BIGQUERY_TYPES.get(field.field_type, pa.string()))
+        for field in fields])
+
+
+def convert_to_string(value):
+    """
+    Store repeated and nested values as JSON, and anything else that isn't
+    already a string as its text.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def create_page_table(page_rows, schema):
+    """
+    Build an Arrow table from one page of REST rows, with every column
+    given the type in the schema rather than one guessed from its values.
+    """
+    columns = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in page_rows]
+        if field.type == pa.string():
+            values = [convert_to_string(value) for value in values]
+        columns.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def open_table_writer(destination_file_path, schema,
+                      destination_file_format='csv', compression='none',
+                      parquet_compression='snappy'):
+    """
+    Open the csv file or parquet writer that Arrow pages are written to.
+    """
+    if destination_file_format == 'parquet':
+        return pq.ParquetWriter(destination_file_path, schema,
+                                compression=parquet_compression)
+    return open_destination_file(destination_file_path, compression)
+
+
+def close_table_writer(writer, destination_file_path,
+                       destination_file_format='csv'):
+    """
+    Close the csv file or parquet writer once every page has been written.
+    """
+    if destination_file_format == 'parquet':
+        writer.close()
+    else:
+        close_destination_file(writer, destination_file_path)
+
+
+def write_table(writer, table, destination_file_format='csv',
+                file_header=False):
+    """
+    Write one page of results to an open csv file or parquet writer.
+    """
+    if destination_file_format == 'parquet':
+        writer.write_table(table)
+    else:
+        table.to_pandas().to_csv(writer, index=False, header=file_header)
+
+
+def create_read_session(storage_client, table, max_streams=4):
+    """
+    Open a Storage Read API session over the table, split into at most
+    max_streams streams that can be read in parallel.
+    """
+    requested_session = bigquery_storage_v1.types.ReadSession(
+        table=f'projects/{table.project}/datasets/{table.dataset_id}/tables/{table.table_id}',
+        data_format=bigquery_storage_v1.enums.DataFormat.ARROW)
+    return storage_client.create_read_session(
+        parent=f'projects/{table.project}', read_session=requested_session,
+        max_stream_count=max_streams)
+
+
+def put_page(page_queue, table, stop_event):
+    """
+    Hand a page to the writer, waiting while the queue is full. Gives up
+    if the writer has stopped, so a failed write can't leave readers
+    blocked forever.
+    """
+    while True:
+        try:
+            page_queue.put(table, timeout=1)
+            return
+        except queue.Full:
+            if stop_event.is_set():
+                raise RuntimeError('Stopped reading, the writer has failed.')
+
+
+def read_stream_to_queue(storage_client, session, stream_name, page_queue,
+                         stop_event):
+    """
+    Read every page of a stream onto the shared queue. None is always put
+    last, so the writer knows when each stream has finished.
+    """
+    try:
+        reader = storage_client.read_rows(stream_name)
+        for page in reader.rows(session).pages:
+            put_page(page_queue, page.to_arrow(), stop_event)
+    finally:
+        put_page(page_queue, None, stop_event)
+
+
+def read_stream_to_file(storage_client, session, stream_name,
+                        destination_file_path, destination_file_format='csv',
+                        compression='none', parquet_compression='snappy'):
+    """
+    Read every page of a stream into its own part file, one page at a time.
+    Returns the number of rows written.
+    """
+    reader = storage_client.read_rows(stream_name)
+    schema = None
+    writer = None
+    row_count = 0
+    try:
+        for page in reader.rows(session).pages:
+            table = page.to_arrow()
+            if not writer:
+                schema = create_arrow_schema(table.schema)
+                writer = open_table_writer(
+                    destination_file_path, schema, destination_file_format,
+                    compression, parquet_compression)
+            write_table(writer, table.cast(schema), destination_file_format,
+                        file_header=row_count == 0)
+            row_count += table.num_rows
+    finally:
+        if writer:
+            close_table_writer(writer, destination_file_path,
+                               destination_file_format)
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows.')
+    return row_count
+
+
+def write_queued_pages(page_queue, stream_count, destination_file_path,
+                       destination_file_format='csv', compression='none',
+                       parquet_compression='snappy'):
+    """
+    Write pages from every stream into one file as they arrive, until each
+    stream has signalled that it's finished. Returns the number of rows
+    written.
+    """
+    finished_stream_count = 0
+    schema = None
+    writer = None
+    row_count = 0
+    try:
+        while finished_stream_count < stream_count:
+            table = page_queue.get()
+            if table is None:
+                finished_stream_count += 1
+                continue
+            if not writer:
+                schema = create_arrow_schema(table.schema)
+                writer = open_table_writer(
+                    destination_file_path, schema, destination_file_format,
+                    compression, parquet_compression)
+            write_table(writer, table.cast(schema), destination_file_format,
+                        file_header=row_count == 0)
+            row_count += table.num_rows
+    finally:
+        if writer:
+            close_table_writer(writer, destination_file_path,
+                               destination_file_format)
+    return row_count
+
+
+def create_files_with_storage_api(table, storage_client, session,
+                                  destination_file_path,
+                                  destination_file_format='csv',
+                                  compression='none',
+                                  parquet_compression='snappy',
+                                  max_queued_pages=16, merge_files=True):
+    """
+    Read the query's destination table through parallel Storage Read API
+    streams. Pages are either written to one part file per stream, or
+    passed through a queue to a single writer. The queue holds at most
+    max_queued_pages pages, which caps how much of the result is held in
+    memory when the streams read faster than the file can be written.
+    """
+    stream_names = [stream.name for stream in session.streams]
+    print(f'Reading {table.table_id} with {len(stream_names)} streams.')
+    if not stream_names:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=len(stream_names)) as executor:
+        if not merge_files:
+            futures = [
+                executor.submit(
+                    read_stream_to_file, storage_client, session,
+                    stream_name,
+                    enumerate_destination_file_name(
+                        destination_file_path, index + 1),
+                    destination_file_format, compression,
+                    parquet_compression)
+                for index, stream_name in enumerate(stream_names)]
+            return sum(future.result() for future in futures)
+
+        page_queue = queue.Queue(maxsize=max_queued_pages)
+        stop_event = threading.Event()
+        futures = [
+            executor.submit(read_stream_to_queue, storage_client, session,
+                            stream_name, page_queue, stop_event)
+            for stream_name in stream_names]
+        try:
+            row_count = write_queued_pages(
+                page_queue, len(stream_names), destination_file_path,
+                destination_file_format, compression, parquet_compression)
+        except Exception as e:
+            stop_event.set()
+            raise(e)
+        for future in futures:
+            future.result()
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows.')
+    return row_count
+
+
+def create_file_with_rest(table, client, destination_file_path,
+                          destination_file_format='csv', compression='none',
+                          parquet_compression='snappy', page_size=10000):
+    """
+    Read the query's destination table one page at a time through the REST
+    API, writing each page as it arrives. Slower than the Storage Read API,
+    but needs no extra permissions or libraries. csv pages are written
+    straight from their rows, while parquet pages are given the types of
+    the table's BigQuery columns.
+    """
+    rows = client.list_rows(table, page_size=page_size)
+    column_names = [field.name for field in rows.schema]
+    schema = create_bigquery_schema(rows.schema)
+    writer = None
+    row_count = 0
+    try:
+        for page in rows.pages:
+            page_rows = [row.values() for row in page]
+            if not writer:
+                writer = open_table_writer(
+                    destination_file_path, schema, destination_file_format,
+                    compression, parquet_compression)
+            if destination_file_format == 'parquet':
+                write_table(writer, create_page_table(page_rows, schema),
+                            destination_file_format)
+            else:
+                pd.DataFrame.from_records(
+                    page_rows, columns=column_names).to_csv(
+                        writer, index=False, header=row_count == 0)
+            row_count += len(page_rows)
+    finally:
+        if writer:
+            close_table_writer(writer, destination_file_path,
+                               destination_file_format)
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows.')
+    return row_count
+
+
+def create_files_with_streaming(query, client, destination_file_path,
+                                destination_file_format='csv',
+                                compression='none',
+                                parquet_compression='snappy', max_streams=4,
+                                max_queued_pages=16, merge_files=True,
+                                page_size=10000):
+    """
+    Run the query, then stream its destination table to disk without ever
+    holding the full result in memory. Uses the Storage Read API when it's
+    installed and available to the service account, otherwise falls back
+    to paged REST reads.
+    """
+    try:
+        query_job = client.query(query)
+        query_job.result()
+    except Exception as e:
+        print(f'Failed to execute your query: {query}')
+        raise(e)
+    table = query_job.destination
+
+    # Only failures to open a read session, such as missing permissions or
+    # the API not being enabled, fall back to REST. Errors raised once pages
+    # are being written are raised as they are.
+    session = None
+    if bigquery_storage_v1:
+        try:
+            storage_client = bigquery_storage_v1.BigQueryReadClient()
+            session = create_read_session(storage_client, table, max_streams)
+        except Exception as e:
+            print(f'Failed to open a Storage Read API session: {e}')
+            print('Falling back to paged REST reads.')
+    else:
+        print('google-cloud-bigquery-storage is not installed. '
+              'Falling back to paged REST reads.')
+
+    if session:
+        return create_files_with_storage_api(
+            table=table, storage_client=storage_client, session=session,
+            destination_file_path=destination_file_path,
+            destination_file_format=destination_file_format,
+            compression=compression,
+            parquet_compression=parquet_compression,
+            max_queued_pages=max_queued_pages, merge_files=merge_files)
+
+    return create_file_with_rest(
+        table=table, client=client,
+        destination_file_path=destination_file_path,
+        destination_file_format=destination_file_format,
+        compression=compression, parquet_compression=parquet_compression,
+        page_size=page_size)
+
+
 def main():
     args = get_args()
     tmp_file = set_environment_variables(args)
     destination_file_name = args.destination_file_name
     destination_folder_name = args.destination_folder_name
+    destination_file_format = args.destination_file_format
+    parquet_compression = args.parquet_compression
+    compression = args.compression
+    row_group_size = int(args.row_group_size)
+    export_method = args.export_method
+    max_streams = int(args.max_streams)
+    max_queued_pages = int(args.max_queued_pages)
+    merge_files = convert_to_boolean(args.merge_files)
     destination_full_path = combine_folder_and_file_name(
         folder_name=destination_folder_name, file_name=destination_file_name)
     query = args.query
@@ -103,8 +721,27 @@ def main():
             destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    create_csv(query=query, client=client,
-            destination_file_path=destination_full_path)
+    if destination_file_format == 'csv':
+        destination_full_path = add_compression_extension(
+            destination_full_path, compression)
+
+    if export_method == 'storage_api':
+        create_files_with_streaming(query=query, client=client,
+                destination_file_path=destination_full_path,
+                destination_file_format=destination_file_format,
+                compression=compression,
+                parquet_compression=parquet_compression,
+                max_streams=max_streams, max_queued_pages=max_queued_pages,
+                merge_files=merge_files, page_size=row_group_size)
+    elif destination_file_format == 'parquet':
+        create_parquet(query=query, client=client,
+                destination_file_path=destination_full_path,
+                row_group_size=row_group_size,
+                compression=parquet_compression)
+    else:
+        create_csv(query=query, client=client,
+                destination_file_path=destination_full_path,
+                compression=compression)
 
     if tmp_file:
         print(f'Removing temporary credentials file {tmp_file}')
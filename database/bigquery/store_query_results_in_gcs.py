@@ -1,12 +1,16 @@
+import io
 import os
 import json
+import struct
 import tempfile
 import argparse
 import re
 
 import pandas as pd
+import pyarrow.parquet as pq
 
 from google.cloud import bigquery
+from google.cloud import storage
 from google.oauth2 import service_account
 from google.api_core.exceptions import BadRequest
 
@@ -21,10 +25,34 @@ def get_args():
                         default='output.csv', required=True)
     parser.add_argument('--destination-folder-name',
                         dest='destination_folder_name', default='', required=False)
+    parser.add_argument('--destination-file-format',
+                        dest='destination_file_format',
+                        choices={'csv', 'json', 'avro', 'parquet'},
+                        default='csv', required=False)
+    parser.add_argument('--compression', dest='compression',
+                        choices={'none', 'gzip', 'deflate', 'snappy', 'zstd'},
+                        default='none', required=False)
+    parser.add_argument('--shard-files', dest='shard_files', default='False',
+                        required=False)
+    parser.add_argument('--write-manifest', dest='write_manifest',
+                        default='True', required=False)
     args = parser.parse_args()
     return args
 
 
+EXTRACT_FORMATS = {
+    'csv': 'CSV',
+    'json': 'NEWLINE_DELIMITED_JSON',
+    'avro': 'AVRO',
+    'parquet': 'PARQUET'}
+
+SUPPORTED_COMPRESSIONS = {
+    'csv': {'none', 'gzip'},
+    'json': {'none', 'gzip'},
+    'avro': {'none', 'deflate', 'snappy'},
+    'parquet': {'none', 'gzip', 'snappy', 'zstd'}}
+
+
 def set_environment_variables(args):
     """
     Set GCP credentials as environment variables if they're provided via keyword
@@ -46,6 +74,18 @@ def set_environment_variables(args):
         return
 
 
+def convert_to_boolean(string):
+    """
+    Shipyard can't support passing Booleans to code, so we have to convert
+    string values to their boolean values.
+    """
+    if string in ['True', 'true', 'TRUE']:
+        value = True
+    else:
+        value = False
+    return value
+
+
 def combine_folder_and_file_name(folder_name, file_name):
     """
     Combine together the provided folder_name and file_name into one path variable.
@@ -88,30 +128,127 @@ def run_query(query, client):
     return project_id, dataset_id, table_id, location
 
 
-def store_temp_table_to_gcs(project_id, dataset_id, table_id, location, bucket_name, destination_full_path, client):
+def create_extract_job_config(destination_file_format='csv',
+                              compression='none'):
+    """
+    Build the extract job configuration, checking up front that BigQuery
+    supports the requested compression for the requested format.
+    """
+    if compression not in SUPPORTED_COMPRESSIONS[destination_file_format]:
+        raise ValueError(
+            f'{compression} compression is not supported for '
+            f'{destination_file_format} exports. Choose one of '
+            f'{", ".join(sorted(SUPPORTED_COMPRESSIONS[destination_file_format]))}.')
+    return bigquery.ExtractJobConfig(
+        destination_format=EXTRACT_FORMATS[destination_file_format],
+        compression=compression.upper())
+
 
-    destination_uri = f'gs://{bucket_name}/{destination_full_path}'
+def store_temp_table_to_gcs(project_id, dataset_id, table_id, location,
+                            bucket_name, destination_full_path, client,
+                            destination_file_format='csv', compression='none',
+                            shard_files=False):
+    """
+    Export the temporary table to GCS. Sharded exports use a wildcard URI,
+    so BigQuery writes the shards in parallel. Unsharded exports fall back
+    to a wildcard URI when the results are too big for a single file.
+    Returns the destination URI that was used and the number of files
+    BigQuery wrote to it.
+    """
     dataset_ref = bigquery.DatasetReference(project_id, dataset_id)
     table_ref = dataset_ref.table(table_id)
+    job_config = create_extract_job_config(
+        destination_file_format, compression)
+
+    if shard_files:
+        destination_uri = f'gs://{bucket_name}/{enumerate_destination_file_name(destination_full_path)}'
+    else:
+        destination_uri = f'gs://{bucket_name}/{destination_full_path}'
 
     try:
         extract_job = client.extract_table(
             table_ref,
             destination_uri,
-            location="US")
-
+            location=location,
+            job_config=job_config)
         extract_job.result()
     except BadRequest as e:
-
+        if shard_files:
+            raise(e)
         destination_uri = f'gs://{bucket_name}/{enumerate_destination_file_name(destination_full_path)}'
         extract_job = client.extract_table(
             table_ref,
             destination_uri,
-            location="US")
+            location=location,
+            job_config=job_config)
+        extract_job.result()
     except Exception as e:
         raise(e)
 
     print(f'Successfully exported your query to {destination_uri}')
+    return destination_uri, extract_job.destination_uri_file_counts[0]
+
+
+def find_exported_blobs(storage_client, bucket_name, destination_uri,
+                        file_count=1):
+    """
+    Return the blobs the export wrote for the destination URI, in shard
+    order. BigQuery numbers the shards of a wildcard URI from
+    000000000000, so the names are built from the export's file count
+    rather than listed, which would also pick up stale shards left by an
+    earlier, larger export to the same name.
+    """
+    blob_name = destination_uri[len(f'gs://{bucket_name}/'):]
+    if '*' in blob_name:
+        blob_names = [blob_name.replace('*', f'{index:012d}', 1)
+                      for index in range(file_count)]
+    else:
+        blob_names = [blob_name]
+    bucket = storage_client.bucket(bucket_name)
+    return [bucket.get_blob(blob_name) for blob_name in blob_names]
+
+
+def read_parquet_row_count(blob):
+    """
+    Read the row count of a parquet shard from its footer, downloading only
+    the footer rather than the whole file.
+    """
+    footer_end = blob.download_as_string(start=blob.size - 8, end=blob.size - 1)
+    metadata_length = struct.unpack('<i', footer_end[:4])[0]
+    footer = blob.download_as_string(
+        start=blob.size - 8 - metadata_length, end=blob.size - 1)
+    return pq.read_metadata(io.BytesIO(b'PAR1' + footer)).num_rows
+
+
+def write_manifest(storage_client, bucket_name, destination_uri,
+                   destination_full_path, table_row_count, file_count=1,
+                   destination_file_format='csv'):
+    """
+    Write a manifest listing every exported shard next to the export, so
+    downstream loaders can fan out across the shards. Parquet shards carry
+    their own row counts. For other formats only the total row count of the
+    table is known.
+    """
+    blobs = find_exported_blobs(storage_client, bucket_name, destination_uri,
+                                file_count)
+    entries = []
+    for blob in blobs:
+        meta = {'content_length': blob.size}
+        if destination_file_format == 'parquet':
+            meta['record_count'] = read_parquet_row_count(blob)
+        entries.append({'url': f'gs://{bucket_name}/{blob.name}', 'meta': meta})
+
+    manifest = {
+        'entries': entries,
+        'meta': {
+            'destination_format': EXTRACT_FORMATS[destination_file_format],
+            'record_count': table_row_count}}
+    manifest_name = f'{destination_full_path}.manifest.json'
+    storage_client.bucket(bucket_name).blob(manifest_name).upload_from_string(
+        json.dumps(manifest, indent=2), content_type='application/json')
+    print(f'Wrote a manifest of {len(entries)} files to '
+          f'gs://{bucket_name}/{manifest_name}')
+    return manifest
 
 
 def get_client(credentials):
@@ -137,6 +274,10 @@ def main():
     destination_full_path = combine_folder_and_file_name(
         folder_name=destination_folder_name, file_name=destination_file_name)
     query = args.query
+    destination_file_format = args.destination_file_format
+    compression = args.compression
+    shard_files = convert_to_boolean(args.shard_files)
+    should_write_manifest = convert_to_boolean(args.write_manifest)
 
     if tmp_file:
         client = get_client(tmp_file)
@@ -146,8 +287,23 @@ def main():
     project_id, dataset_id, table_id, location = run_query(
         query=query, client=client)
     print('Query finished successfully. Storing results on GCS.')
-    store_temp_table_to_gcs(project_id=project_id, dataset_id=dataset_id, table_id=table_id,
-                            location=location, bucket_name=bucket_name, destination_full_path=destination_full_path, client=client)
+    destination_uri, file_count = store_temp_table_to_gcs(
+        project_id=project_id, dataset_id=dataset_id, table_id=table_id,
+        location=location, bucket_name=bucket_name,
+        destination_full_path=destination_full_path, client=client,
+        destination_file_format=destination_file_format,
+        compression=compression, shard_files=shard_files)
+
+    if should_write_manifest:
+        table = client.get_table(
+            bigquery.DatasetReference(project_id, dataset_id).table(table_id))
+        write_manifest(storage_client=storage.Client(),
+                       bucket_name=bucket_name,
+                       destination_uri=destination_uri,
+                       destination_full_path=destination_full_path,
+                       table_row_count=table.num_rows,
+                       file_count=file_count,
+                       destination_file_format=destination_file_format)
 
     if tmp_file:
         print(f'Removing temporary credentials file {tmp_file}')
@@ -1,8 +1,16 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 import argparse
+import hashlib
+import io
+import json
 import os
+import random
 import glob
 import re
+import time
+import uuid
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 
 
@@ -29,10 +37,41 @@ def get_args():
                         required=True)
     parser.add_argument('--insert-method', dest='insert_method', choices={'fail', 'replace', 'append'}, default='append',
                         required=False)
+    parser.add_argument('--load-method', dest='load_method',
+                        choices={'insert', 'bulk_copy'}, default='insert',
+                        required=False)
+    parser.add_argument('--batch-size', dest='batch_size', default='10000',
+                        required=False)
+    parser.add_argument('--table-lock', dest='table_lock', default='False',
+                        required=False)
+    parser.add_argument('--odbc-driver', dest='odbc_driver',
+                        default='ODBC Driver 17 for SQL Server', required=False)
+    parser.add_argument('--commit-interval', dest='commit_interval',
+                        default='100000', required=False)
+    parser.add_argument('--schema-cache-file', dest='schema_cache_file',
+                        default='schema_cache.json', required=False)
+    parser.add_argument('--parallelism', dest='parallelism', default='1',
+                        required=False)
+    parser.add_argument('--serial-load', dest='serial_load', default='False',
+                        required=False)
+    parser.add_argument('--resume', dest='resume', default='False',
+                        required=False)
     args = parser.parse_args()
     return args
 
 
+def convert_to_boolean(string):
+    """
+    Shipyard can't support passing Booleans to code, so we have to convert
+    string values to their boolean values.
+    """
+    if string in ['True', 'true', 'TRUE']:
+        value = True
+    else:
+        value = False
+    return value
+
+
 def find_all_local_file_names(source_folder_name):
     """
     Returns a list of all files that exist in the current working directory,
@@ -66,10 +105,471 @@ def combine_folder_and_file_name(folder_name, file_name):
     return combined_name
 
 
-def upload_data(source_full_path, table_name, insert_method, db_connection):
-    for chunk in pd.read_csv(source_full_path, chunksize=10000):
-        chunk.to_sql(table_name, con=db_connection, index=False,
-                     if_exists=insert_method, chunksize=10000)
+def print_throughput(row_count, start_time):
+    """
+    Print how many rows were loaded and how quickly.
+    """
+    elapsed_time = max(time.time() - start_time, 0.001)
+    print(
+        f'Loaded {row_count} rows in {elapsed_time:.2f} seconds '
+        f'({row_count / elapsed_time:.0f} rows/sec).')
+
+
+def print_load_summary(load_results, start_time):
+    """
+    Print the rows loaded and throughput of every file, followed by the
+    totals for the whole load.
+    """
+    total_row_count = 0
+    for source_full_path, row_count, elapsed_time in load_results:
+        elapsed_time = max(elapsed_time, 0.001)
+        print(f'{source_full_path}: {row_count} rows in {elapsed_time:.2f} '
+              f'seconds ({row_count / elapsed_time:.0f} rows/sec).')
+        total_row_count += row_count
+    print(f'{len(load_results)} files loaded.')
+    print_throughput(total_row_count, start_time)
+
+
+def read_sample(source_full_path, sample_size=10000, seek_count=10):
+    """
+    Read a sample of the file as strings: the first sample_size rows, plus
+    sample_size / seek_count rows from each of seek_count random offsets,
+    so values that only appear further into the file are seen too. Windows
+    that start inside a quoted value can't be parsed and are skipped.
+    """
+    samples = [pd.read_csv(source_full_path, nrows=sample_size, dtype=str)]
+    file_size = os.path.getsize(source_full_path)
+    with open(source_full_path, 'rb') as source_file:
+        header = source_file.readline().decode('utf-8')
+        offsets = random.sample(range(file_size), min(seek_count, file_size))
+        for offset in sorted(offsets):
+            source_file.seek(offset)
+            # Skip the rest of the line the offset landed in.
+            source_file.readline()
+            lines = b''.join(source_file.readline()
+                             for _ in range(sample_size // seek_count))
+            try:
+                window = pd.read_csv(
+                    io.StringIO(header + lines.decode('utf-8', 'replace')),
+                    dtype=str)
+            except Exception:
+                continue
+            if list(window.columns) == list(samples[0].columns):
+                samples.append(window)
+    return pd.concat(samples, ignore_index=True)
+
+
+def infer_column_types(sample):
+    """
+    Pick one pandas dtype per column from the sampled strings. Whole
+    numbers become nullable Int64, so a missing value doesn't turn the
+    column into floats, other numbers become float64 and everything else
+    stays a string. Columns that are empty or boolean in the sample are
+    left for pandas to infer.
+    """
+    column_types = {}
+    for column_name in sample.columns:
+        values = sample[column_name].dropna().str.strip()
+        if values.empty or values.str.lower().isin(['true', 'false']).all():
+            column_types[column_name] = None
+        elif values.str.match(r'^[+-]?\d{1,18}$').all():
+            column_types[column_name] = 'Int64'
+        elif pd.to_numeric(values, errors='coerce').notnull().all():
+            column_types[column_name] = 'float64'
+        else:
+            column_types[column_name] = 'object'
+    return column_types
+
+
+def get_column_types(source_full_path, table_name, schema_cache_file):
+    """
+    Return the column type map for the file, sampling it only when the
+    cache has no map for this table and header yet. Every chunk of every
+    matched file is read with the same map, so a column can't change type
+    from one chunk to the next. Delete the cache file to sample again.
+    """
+    with open(source_full_path, 'rb') as source_file:
+        header = source_file.readline()
+    cache_key = f'{table_name}:{hashlib.sha256(header).hexdigest()}'
+
+    schema_cache = {}
+    if os.path.exists(schema_cache_file):
+        with open(schema_cache_file, 'r') as cache_file:
+            schema_cache = json.load(cache_file)
+
+    if cache_key in schema_cache:
+        column_types = schema_cache[cache_key]
+        print(f'Using the cached column types for {table_name}.')
+    else:
+        sample = read_sample(source_full_path)
+        column_types = [
+            [str(column_name), column_type] for column_name, column_type
+            in infer_column_types(sample).items()]
+        schema_cache[cache_key] = column_types
+        temporary_file_name = f'{schema_cache_file}.tmp'
+        with open(temporary_file_name, 'w') as cache_file:
+            json.dump(schema_cache, cache_file, indent=2)
+        os.replace(temporary_file_name, schema_cache_file)
+        print(f'Sampled {len(sample)} rows to infer the column types of '
+              f'{table_name}.')
+
+    return {column_name: column_type
+            for column_name, column_type in column_types if column_type}
+
+
+def ends_inside_quotes(line, in_quotes=False, delimiter=b',', quote=b'"'):
+    """
+    Check whether a quoted value is still open at the end of the line. A
+    quote only opens a value at the start of a field, and two quotes in a
+    row inside a value are an escaped quote, the same way the csv is
+    parsed. A stray quote in the middle of a field, like 12" ruler, is just
+    part of the value.
+    """
+    if not in_quotes and quote not in line:
+        return False
+    field_start = True
+    index = 0
+    while index < len(line):
+        character = line[index:index + 1]
+        if in_quotes:
+            if character == quote:
+                if line[index + 1:index + 2] == quote:
+                    index += 1
+                else:
+                    in_quotes = False
+        elif character == quote and field_start:
+            in_quotes = True
+        field_start = not in_quotes and character == delimiter
+        index += 1
+    return in_quotes
+
+
+def read_chunks(source_full_path, chunk_size=10000, byte_offset=0,
+                column_types=None):
+    """
+    Read a csv in chunks of chunk_size rows, starting at byte_offset. Each
+    chunk is yielded with the byte offset just past its last row, so a load
+    can record exactly how far it got and later seek straight back there.
+    Lines are kept together while a quoted value is open, so newlines inside
+    quotes never split a row across chunks.
+    """
+    read_options = dict(dtype=column_types)
+    with open(source_full_path, 'rb') as source_file:
+        header = source_file.readline()
+        byte_offset = max(byte_offset, len(header))
+        source_file.seek(byte_offset)
+        lines = []
+        in_quotes = False
+        for line in source_file:
+            byte_offset += len(line)
+            lines.append(line)
+            in_quotes = ends_inside_quotes(line, in_quotes)
+            if in_quotes or len(lines) < chunk_size:
+                continue
+            yield pd.read_csv(io.BytesIO(header + b''.join(lines)),
+                              **read_options), byte_offset
+            lines = []
+        if b''.join(lines).strip():
+            yield pd.read_csv(io.BytesIO(header + b''.join(lines)),
+                              **read_options), byte_offset
+
+
+def create_checkpoint_file_name(source_full_path):
+    """
+    Return the name of the checkpoint file kept next to the source file. It
+    is hidden, so it is never picked up by a regex match on the folder.
+    """
+    folder_name, file_name = os.path.split(source_full_path)
+    return os.path.join(folder_name, f'.{file_name}.checkpoint.json')
+
+
+def read_checkpoint(source_full_path, table_name):
+    """
+    Return the last checkpoint recorded while loading the file into the
+    table, or None if there isn't one or it was written for a different
+    table or a different version of the file.
+    """
+    checkpoint_file_name = create_checkpoint_file_name(source_full_path)
+    if not os.path.exists(checkpoint_file_name):
+        return None
+    with open(checkpoint_file_name, 'r') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint['table_name'] != table_name or \
+            checkpoint['file_size'] != os.path.getsize(source_full_path):
+        print(f'Ignoring the checkpoint for {source_full_path}, since it was '
+              'written for a different table or file.')
+        return None
+    return checkpoint
+
+
+def write_checkpoint(source_full_path, table_name, byte_offset, row_count,
+                     batch_id, complete=False):
+    """
+    Record how much of the file has been committed. The checkpoint is
+    written to a temporary file and renamed into place, so a crash can't
+    leave a partially written checkpoint behind.
+    """
+    checkpoint = dict(
+        file=source_full_path, table_name=table_name,
+        file_size=os.path.getsize(source_full_path), byte_offset=byte_offset,
+        row_count=row_count, batch_id=batch_id, complete=complete)
+    checkpoint_file_name = create_checkpoint_file_name(source_full_path)
+    temporary_file_name = f'{checkpoint_file_name}.tmp'
+    with open(temporary_file_name, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2)
+    os.replace(temporary_file_name, checkpoint_file_name)
+
+
+def remove_checkpoints(matching_file_names):
+    """
+    Delete the checkpoints of every file once the whole load has succeeded.
+    """
+    for file_name in matching_file_names:
+        checkpoint_file_name = create_checkpoint_file_name(file_name)
+        if os.path.exists(checkpoint_file_name):
+            os.remove(checkpoint_file_name)
+
+
+def create_unique_table_name(table_name, purpose):
+    """
+    Name a table this run creates for its own use. The random suffix means
+    it can never collide with a user's table or with another run loading
+    into the same table.
+    """
+    return f'{table_name}_{purpose}_{uuid.uuid4().hex}'
+
+
+def find_checkpoint_table_name(matching_file_names, table_name):
+    """
+    Return the table a previous run of this load was writing into, taken
+    from the checkpoints it left behind, so a resumed run keeps loading
+    into the same staging table.
+    """
+    for file_name in matching_file_names:
+        checkpoint_file_name = create_checkpoint_file_name(file_name)
+        if not os.path.exists(checkpoint_file_name):
+            continue
+        with open(checkpoint_file_name, 'r') as checkpoint_file:
+            checkpoint_table_name = json.load(checkpoint_file)['table_name']
+        if checkpoint_table_name == table_name or \
+                checkpoint_table_name.startswith(f'{table_name}_staging_'):
+            return checkpoint_table_name
+    return None
+
+
+def prepare_table(source_full_path, table_name, insert_method, db_connection,
+                  column_types=None, resume_table_name=None):
+    """
+    Create or check the table once, before any data is loaded, and return
+    the name of the table that every file should be loaded into. With
+    insert_method=replace the data goes into a fresh staging table that is
+    swapped in once everything has loaded, so the existing table stays
+    readable and complete until then. New tables are created from the column
+    types pandas infers on a sample of the first file. When resuming, the
+    table a previous run was loading into is kept as it is.
+    """
+    if resume_table_name and db_connection.has_table(resume_table_name):
+        print(f'Resuming the load into {resume_table_name}.')
+        return resume_table_name
+
+    load_table_name = table_name
+    if insert_method == 'replace':
+        load_table_name = create_unique_table_name(table_name, 'staging')
+
+    table_exists = db_connection.has_table(table_name)
+    if table_exists and insert_method == 'fail':
+        raise ValueError(f'Table {table_name} already exists.')
+    if table_exists and insert_method == 'append':
+        return table_name
+
+    sample = pd.read_csv(source_full_path, nrows=10000, dtype=column_types)
+    sample.head(0).to_sql(load_table_name, con=db_connection, index=False,
+                          if_exists='fail')
+    return load_table_name
+
+
+def swap_staging_table(staging_table_name, table_name, db_connection):
+    """
+    Replace table_name with the fully loaded staging table. The drop and the
+    rename run in one transaction, so readers see either the old table or
+    the new one, never a partial load.
+    """
+    with db_connection.begin() as connection:
+        connection.execute(
+            text("IF OBJECT_ID(:table_name, 'U') IS NOT NULL "
+                 f"DROP TABLE [{table_name}]"),
+            table_name=table_name)
+        connection.execute(
+            text('EXEC sp_rename :staging_table_name, :table_name'),
+            staging_table_name=staging_table_name, table_name=table_name)
+    print(f'Swapped {staging_table_name} in as {table_name}.')
+
+
+def upload_data(source_full_path, table_name, db_connection,
+                commit_interval=100000, column_types=None, checkpoint=None):
+    """
+    Insert a csv in chunks of 10000 rows on a single connection, committing
+    every commit_interval rows rather than after every chunk. A checkpoint
+    is written after every commit, and loading starts from the checkpoint
+    when one is given.
+    """
+    start_time = time.time()
+    byte_offset = 0
+    row_count = 0
+    batch_id = 0
+    if checkpoint:
+        byte_offset = checkpoint['byte_offset']
+        row_count = checkpoint['row_count']
+        batch_id = checkpoint['batch_id']
+        print(f'Resuming {source_full_path} from byte {byte_offset}, after '
+              f'{row_count} rows.')
+    start_row_count = row_count
+    uncommitted_row_count = 0
+    with db_connection.connect() as connection:
+        transaction = connection.begin()
+        try:
+            for chunk, chunk_offset in read_chunks(
+                    source_full_path, 10000, byte_offset,
+                    column_types=column_types):
+                chunk.to_sql(table_name, con=connection, index=False,
+                             if_exists='append', chunksize=10000)
+                row_count += len(chunk)
+                uncommitted_row_count += len(chunk)
+                if uncommitted_row_count >= commit_interval:
+                    transaction.commit()
+                    batch_id += 1
+                    write_checkpoint(source_full_path, table_name,
+                                     chunk_offset, row_count, batch_id)
+                    transaction = connection.begin()
+                    uncommitted_row_count = 0
+            transaction.commit()
+            write_checkpoint(source_full_path, table_name,
+                             os.path.getsize(source_full_path), row_count,
+                             batch_id + 1, complete=True)
+        except Exception as e:
+            transaction.rollback()
+            print(f'Failed to upload {source_full_path} to {table_name}')
+            raise(e)
+    print_throughput(row_count - start_row_count, start_time)
+    return row_count - start_row_count
+
+
+def bulk_copy_data(source_full_path, table_name, db_connection,
+                   batch_size=10000, table_lock=False, commit_interval=100000,
+                   column_types=None, checkpoint=None):
+    """
+    Load a csv with pyodbc's fast_executemany, which sends each batch of rows
+    to the server as a single parameter array instead of one round trip per
+    row. Rows are committed every commit_interval rows, with a checkpoint
+    written after every commit, and loading starts from the checkpoint when
+    one is given.
+    """
+    start_time = time.time()
+    byte_offset = 0
+    row_count = 0
+    batch_id = 0
+    if checkpoint:
+        byte_offset = checkpoint['byte_offset']
+        row_count = checkpoint['row_count']
+        batch_id = checkpoint['batch_id']
+        print(f'Resuming {source_full_path} from byte {byte_offset}, after '
+              f'{row_count} rows.')
+    start_row_count = row_count
+    uncommitted_row_count = 0
+    connection = db_connection.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.fast_executemany = True
+        insert_statement = None
+        for chunk, chunk_offset in read_chunks(
+                source_full_path, batch_size, byte_offset,
+                column_types=column_types):
+            if not insert_statement:
+                columns = ', '.join(
+                    f'[{column_name.replace("]", "]]")}]'
+                    for column_name in chunk.columns)
+                placeholders = ', '.join('?' for _ in chunk.columns)
+                insert_statement = (
+                    f'INSERT INTO [{table_name}]'
+                    f'{" WITH (TABLOCK)" if table_lock else ""} '
+                    f'({columns}) VALUES ({placeholders})')
+            rows = chunk.astype(object).where(chunk.notnull(), None)
+            cursor.executemany(insert_statement, rows.values.tolist())
+            row_count += len(chunk)
+            uncommitted_row_count += len(chunk)
+            if uncommitted_row_count >= commit_interval:
+                connection.commit()
+                batch_id += 1
+                write_checkpoint(source_full_path, table_name, chunk_offset,
+                                 row_count, batch_id)
+                uncommitted_row_count = 0
+        connection.commit()
+        write_checkpoint(source_full_path, table_name,
+                         os.path.getsize(source_full_path), row_count,
+                         batch_id + 1, complete=True)
+        cursor.close()
+    except Exception as e:
+        connection.rollback()
+        print(f'Failed to bulk copy {source_full_path} to {table_name}')
+        raise(e)
+    finally:
+        connection.close()
+    print_throughput(row_count - start_row_count, start_time)
+    return row_count - start_row_count
+
+
+def create_db_connection(db_string):
+    """
+    Create the engine every file is loaded through.
+    """
+    return create_engine(
+        db_string, execution_options=dict(
+            stream_results=True))
+
+
+def load_file(source_full_path, table_name, db_connection,
+              load_method='insert', batch_size=10000, table_lock=False,
+              commit_interval=100000, column_types=None, resume=False):
+    """
+    Load one file with the requested load method. Returns the file name,
+    the number of rows loaded and how long the load took. When resuming,
+    files that were fully loaded are skipped and partly loaded files pick
+    up from their last checkpoint.
+    """
+    start_time = time.time()
+    checkpoint = read_checkpoint(source_full_path, table_name) \
+        if resume else None
+    if checkpoint and checkpoint['complete']:
+        print(f'{source_full_path} was already uploaded to {table_name}.')
+        return source_full_path, 0, 0
+    if load_method == 'bulk_copy':
+        row_count = bulk_copy_data(
+            source_full_path=source_full_path, table_name=table_name,
+            db_connection=db_connection, batch_size=batch_size,
+            table_lock=table_lock, commit_interval=commit_interval,
+            column_types=column_types, checkpoint=checkpoint)
+    else:
+        row_count = upload_data(
+            source_full_path=source_full_path, table_name=table_name,
+            db_connection=db_connection, commit_interval=commit_interval,
+            column_types=column_types, checkpoint=checkpoint)
+    print(f'{source_full_path} has been uploaded to {table_name}.')
+    return source_full_path, row_count, time.time() - start_time
+
+
+def load_file_in_process(db_string, source_full_path, table_name,
+                         **load_options):
+    """
+    Load one file from a worker process. Engines can't be shared between
+    processes, so each worker opens its own single connection, which keeps
+    the number of connections bounded by the number of workers.
+    """
+    db_connection = create_db_connection(db_string)
+    try:
+        return load_file(source_full_path, table_name, db_connection,
+                         **load_options)
+    finally:
+        db_connection.dispose()
 
 
 def main():
@@ -87,26 +587,75 @@ def main():
     url_parameters = args.url_parameters
     table_name = args.table_name
     insert_method = args.insert_method
+    load_method = args.load_method
+    batch_size = int(args.batch_size)
+    table_lock = convert_to_boolean(args.table_lock)
+    commit_interval = int(args.commit_interval)
+    schema_cache_file = args.schema_cache_file
+    parallelism = int(args.parallelism)
+    serial_load = convert_to_boolean(args.serial_load)
+    resume = convert_to_boolean(args.resume)
 
-    db_string = f'mssql+pymssql://{username}:{password}@{host}:{port}/{database}?{url_parameters}'
-    db_connection = create_engine(
-        db_string, execution_options=dict(
-            stream_results=True))
+    if load_method == 'bulk_copy':
+        odbc_driver = urllib.parse.quote_plus(args.odbc_driver)
+        db_string = f'mssql+pyodbc://{username}:{password}@{host}:{port}/{database}?driver={odbc_driver}&{url_parameters}'
+    else:
+        db_string = f'mssql+pymssql://{username}:{password}@{host}:{port}/{database}?{url_parameters}'
+    db_connection = create_db_connection(db_string)
 
     if source_file_name_match_type == 'regex_match':
         file_names = find_all_local_file_names(source_folder_name)
         matching_file_names = find_all_file_matches(
             file_names, re.compile(source_file_name))
         print(f'{len(matching_file_names)} files found. Preparing to upload...')
+    else:
+        matching_file_names = [source_full_path]
+
+    if not matching_file_names:
+        return
 
-        for index, key_name in enumerate(matching_file_names):
-            upload_data(source_full_path=key_name, table_name=table_name,
-                        insert_method=insert_method, db_connection=db_connection)
-            print(f'{key_name} has been uploaded to {table_name}.')
+    resume_table_name = find_checkpoint_table_name(
+        matching_file_names, table_name) if resume else None
 
+    column_types = get_column_types(
+        source_full_path=matching_file_names[0], table_name=table_name,
+        schema_cache_file=schema_cache_file)
+
+    load_table_name = prepare_table(
+        source_full_path=matching_file_names[0], table_name=table_name,
+        insert_method=insert_method, db_connection=db_connection,
+        column_types=column_types,
+        resume_table_name=resume_table_name)
+
+    load_options = dict(
+        load_method=load_method, batch_size=batch_size,
+        table_lock=table_lock, commit_interval=commit_interval,
+        column_types=column_types, resume=resume)
+    load_results = []
+    start_time = time.time()
+    # A serial load ignores --parallelism and loads, and commits, every file
+    # one at a time in the order they were matched.
+    if parallelism > 1 and serial_load:
+        print('Loading files one at a time, in the order they were matched.')
+    if parallelism > 1 and not serial_load and len(matching_file_names) > 1:
+        with ProcessPoolExecutor(max_workers=parallelism) as executor:
+            futures = [
+                executor.submit(load_file_in_process, db_string, key_name,
+                                load_table_name, **load_options)
+                for key_name in matching_file_names]
+            for future in as_completed(futures):
+                load_results.append(future.result())
     else:
-        upload_data(source_full_path=source_full_path, table_name=table_name,
-                    insert_method=insert_method, db_connection=db_connection)
+        for key_name in matching_file_names:
+            load_results.append(load_file(
+                key_name, load_table_name, db_connection, **load_options))
+    print_load_summary(load_results, start_time)
+
+    if load_table_name != table_name:
+        swap_staging_table(
+            staging_table_name=load_table_name, table_name=table_name,
+            db_connection=db_connection)
+    remove_checkpoints(matching_file_names)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,23 @@
 from sqlalchemy import create_engine, text
+from mysql.connector import FieldFlag, FieldType
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+import datetime
+import bz2
+import csv
+import gzip
+import io
+import hashlib
+import json
 import os
+import re
+import resource
+import shutil
+import time
 import pandas as pd
+import zstandard
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 def get_args():
@@ -20,10 +36,60 @@ def get_args():
                         dest='destination_folder_name', default='', required=False)
     parser.add_argument('--file-header', dest='file_header', default='True',
                         required=False)
+    parser.add_argument('--destination-file-format',
+                        dest='destination_file_format',
+                        choices={'csv', 'parquet'}, default='csv',
+                        required=False)
+    parser.add_argument('--parquet-compression', dest='parquet_compression',
+                        choices={'snappy', 'gzip', 'brotli', 'zstd', 'none'},
+                        default='snappy', required=False)
+    parser.add_argument('--row-group-size', dest='row_group_size',
+                        default='10000', required=False)
+    parser.add_argument('--compression', dest='compression',
+                        choices={'none', 'gzip', 'zstd', 'bz2'},
+                        default='none', required=False)
+    parser.add_argument('--partition-column', dest='partition_column',
+                        default=None, required=False)
+    parser.add_argument('--partition-count', dest='partition_count',
+                        default='1', required=False)
+    parser.add_argument('--merge-files', dest='merge_files', default='True',
+                        required=False)
+    parser.add_argument('--export-method', dest='export_method',
+                        choices={'pandas', 'cursor'}, default='pandas',
+                        required=False)
+    parser.add_argument('--fetch-size', dest='fetch_size', default='10000',
+                        required=False)
+    parser.add_argument('--incremental-column', dest='incremental_column',
+                        default=None, required=False)
+    parser.add_argument('--incremental-state-file',
+                        dest='incremental_state_file',
+                        default='incremental_state.json', required=False)
     args = parser.parse_args()
     return args
 
 
+MYSQL_INTEGER_TYPES = {
+    FieldType.TINY,
+    FieldType.SHORT,
+    FieldType.LONG,
+    FieldType.LONGLONG,
+    FieldType.INT24,
+    FieldType.YEAR,
+    FieldType.BIT}
+
+MYSQL_BINARY_TYPES = {
+    FieldType.TINY_BLOB,
+    FieldType.MEDIUM_BLOB,
+    FieldType.LONG_BLOB,
+    FieldType.BLOB,
+    FieldType.VAR_STRING,
+    FieldType.STRING,
+    FieldType.GEOMETRY}
+
+# Character set 63 is MySQL's binary character set.
+BINARY_CHARACTER_SET = 63
+
+
 def convert_to_boolean(string):
     """
     Shipyard can't support passing Booleans to code, so we have to convert
@@ -46,22 +112,701 @@ def combine_folder_and_file_name(folder_name, file_name):
     return combined_name
 
 
-def create_csv(query, db_connection, destination_file_path, file_header=True):
+def add_compression_extension(destination_full_path, compression):
+    """
+    Add the file extension matching the compression method, unless the
+    provided file name already ends with it.
+    """
+    extension = {'gzip': '.gz', 'bz2': '.bz2', 'zstd': '.zst'}.get(compression)
+    if extension and not destination_full_path.endswith(extension):
+        destination_full_path = f'{destination_full_path}{extension}'
+    return destination_full_path
+
+
+def open_destination_file(destination_file_path, compression='none',
+                          buffer_size=8388608):
+    """
+    Open the destination file once for the whole extract, with a large write
+    buffer. Rows are compressed as they are written when a compression
+    method is provided, so the uncompressed file never touches disk. Any
+    file left behind by a previous run is truncated rather than appended to.
+    """
+    if compression == 'gzip':
+        binary_file = gzip.open(destination_file_path, 'wb')
+    elif compression == 'bz2':
+        binary_file = bz2.open(destination_file_path, 'wb')
+    elif compression == 'zstd':
+        # threads=-1 spreads compression across every available core.
+        binary_file = zstandard.ZstdCompressor(threads=-1).stream_writer(
+            open(destination_file_path, 'wb', buffering=buffer_size))
+    else:
+        binary_file = open(destination_file_path, 'wb', buffering=buffer_size)
+    return io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+
+
+def close_destination_file(destination_file, destination_file_path):
+    """
+    Close the destination file, writing out any buffered or compressed data,
+    and fsync it once every row has been written. Returns the number of
+    bytes written.
+    """
+    destination_file.close()
+    file_descriptor = os.open(destination_file_path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+    return os.path.getsize(destination_file_path)
+
+
+def create_csv(query, db_connection, destination_file_path, file_header=True,
+               compression='none'):
     """
     Read in data from a SQL query. Store the data as a csv.
     """
-    i = 1
-    for chunk in pd.read_sql_query(query, db_connection, chunksize=10000):
-        if i == 1:
-            chunk.to_csv(destination_file_path, mode='a',
-                         header=file_header, index=False)
-        else:
-            chunk.to_csv(destination_file_path, mode='a',
-                         header=False, index=False)
-        i += 1
+    row_count = 0
+    destination_file = open_destination_file(destination_file_path, compression)
+    try:
+        for chunk_number, chunk in enumerate(
+                pd.read_sql_query(query, db_connection, chunksize=10000)):
+            chunk.to_csv(destination_file, index=False,
+                         header=file_header if chunk_number == 0 else False)
+            row_count += len(chunk)
+    finally:
+        byte_count = close_destination_file(
+            destination_file, destination_file_path)
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows ({byte_count} bytes).')
+    return row_count, byte_count
+
+
+def promote_arrow_types(field_types):
+    """
+    Pick one type that values of every type in field_types can be stored as.
+    Nulls take the type of the other values, integers mixed with floats
+    become floats and decimals are widened to fit every precision and
+    scale. Any other mix is stored as strings. Columns with nothing but
+    nulls stay null, so a later chunk can still give them a real type.
+    """
+    field_types = [field_type for field_type in field_types
+                   if field_type != pa.null()]
+    if not field_types:
+        return pa.null()
+    if all(field_type == field_types[0] for field_type in field_types):
+        return field_types[0]
+    if all(pa.types.is_integer(field_type) for field_type in field_types):
+        return pa.int64()
+    if all(pa.types.is_integer(field_type) or pa.types.is_floating(field_type)
+           for field_type in field_types):
+        return pa.float64()
+    if all(pa.types.is_decimal(field_type) for field_type in field_types):
+        scale = max(field_type.scale for field_type in field_types)
+        integer_digits = max(field_type.precision - field_type.scale
+                             for field_type in field_types)
+        return pa.decimal128(min(integer_digits + scale, 38), scale)
+    return pa.string()
+
+
+def promote_schemas(schemas):
+    """
+    Build one schema that tables with every schema in schemas can be cast
+    to. Fields are kept in the order of the first schema.
+    """
+    field_types = [dict(zip(schema.names, schema.types))
+                   for schema in schemas]
+    return pa.schema([
+        pa.field(field_name, promote_arrow_types(
+            [types[field_name] for types in field_types
+             if field_name in types]))
+        for field_name in schemas[0].names])
+
+
+def create_merged_schema(file_paths):
+    """
+    Build one schema that every parquet file in file_paths can be cast to,
+    rather than assuming the types of the first file hold for all of them.
+    """
+    return promote_schemas(
+        [pq.read_schema(file_path) for file_path in file_paths])
+
+
+def cast_table(table, schema):
+    """
+    Cast every column of the table to the type in the schema. Columns that
+    Arrow can't cast directly are converted through their Python values.
+    """
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if column.type != field.type:
+            try:
+                column = column.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                values = column.to_pylist()
+                if field.type == pa.string():
+                    values = [None if value is None else str(value)
+                              for value in values]
+                column = pa.array(values, type=field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def widen_parquet_file(writer, destination_file_path, schema, compression):
+    """
+    Rewrite the row groups already written to destination_file_path with
+    the wider schema, then return a writer that appends with that schema.
+    Parquet files have one schema, so this is the only way to widen a
+    column after its first row group.
+    """
+    writer.close()
+    previous_file_path = f'{destination_file_path}.tmp'
+    os.replace(destination_file_path, previous_file_path)
+    previous_file = pq.ParquetFile(previous_file_path)
+    writer = pq.ParquetWriter(destination_file_path, schema,
+                              compression=compression)
+    for row_group in range(previous_file.num_row_groups):
+        writer.write_table(cast_table(
+            previous_file.read_row_group(row_group), schema))
+    os.remove(previous_file_path)
+    return writer
+
+
+def write_parquet_chunk(writer, schema, table, destination_file_path,
+                        compression='snappy', row_group_size=10000):
+    """
+    Write one chunk of results to the parquet file, opening the writer on
+    the first chunk. The first chunk can't know every type, since a column
+    can be null or hold narrower decimals until later, so the schema is
+    widened whenever a chunk doesn't fit it. Returns the writer and the
+    schema to pass along with the next chunk.
+    """
+    if not writer:
+        schema = promote_schemas([table.schema])
+        writer = pq.ParquetWriter(destination_file_path, schema,
+                                  compression=compression)
+    else:
+        wider_schema = promote_schemas([schema, table.schema])
+        if not wider_schema.equals(schema):
+            schema = wider_schema
+            writer = widen_parquet_file(writer, destination_file_path,
+                                        schema, compression)
+    writer.write_table(cast_table(table, schema),
+                       row_group_size=row_group_size)
+    return writer, schema
+
+
+def create_parquet(query, db_connection, destination_file_path,
+                   row_group_size=10000, compression='snappy'):
+    """
+    Read in data from a SQL query. Store the data as a parquet file, writing
+    each chunk as its own row group so the full result is never held in
+    memory.
+    """
+    writer = None
+    schema = None
+    try:
+        for chunk in pd.read_sql_query(query, db_connection,
+                                       chunksize=row_group_size):
+            writer, schema = write_parquet_chunk(
+                writer, schema,
+                pa.Table.from_pandas(chunk, preserve_index=False),
+                destination_file_path, compression, row_group_size)
+    finally:
+        if writer:
+            writer.close()
+    print(f'{destination_file_path} was successfully created.')
     return
 
 
+def print_throughput(row_count, start_time):
+    """
+    Print how many rows were extracted, how quickly, and the most memory
+    the process has used so far.
+    """
+    elapsed_time = max(time.time() - start_time, 0.001)
+    # ru_maxrss is reported in kilobytes on Linux.
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f'Extracted {row_count} rows in {elapsed_time:.2f} seconds '
+        f'({row_count / elapsed_time:.0f} rows/sec). '
+        f'Peak memory usage was {peak_memory:.0f} MB.')
+
+
+def fetch_with_cursor(query, db_connection, fetch_size=10000):
+    """
+    Run the query on an unbuffered cursor and yield the cursor's column
+    descriptions, then lists of at most fetch_size rows. SQLAlchemy's mysqlconnector dialect
+    buffers every result client side, so the raw connection is used to read
+    rows off the socket only as they're fetched, keeping memory bounded by
+    fetch_size no matter how big the result is.
+    """
+    connection = db_connection.raw_connection()
+    try:
+        cursor = connection.cursor(buffered=False)
+        cursor.execute(query)
+        yield cursor.description
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def create_csv_with_cursor(query, db_connection, destination_file_path,
+                           file_header=True, compression='none',
+                           fetch_size=10000):
+    """
+    Read in data from a SQL query with an unbuffered cursor and write each
+    batch of rows straight to a csv, without building DataFrames.
+    """
+    start_time = time.time()
+    row_count = 0
+    destination_file = open_destination_file(destination_file_path, compression)
+    try:
+        batches = fetch_with_cursor(query, db_connection, fetch_size)
+        writer = csv.writer(destination_file)
+        column_names = [column[0] for column in next(batches)]
+        if file_header:
+            writer.writerow(column_names)
+        for rows in batches:
+            writer.writerows(rows)
+            row_count += len(rows)
+    finally:
+        byte_count = close_destination_file(
+            destination_file, destination_file_path)
+    print_throughput(row_count, start_time)
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows ({byte_count} bytes).')
+    return row_count, byte_count
+
+
+def create_cursor_schema(column_descriptions):
+    """
+    Build the parquet schema from the cursor's column descriptions, so every
+    batch is written with the types MySQL reports instead of the types Arrow
+    guesses from the first batch. The driver doesn't report the precision
+    and scale of DECIMAL columns, so they are stored as strings to keep
+    every digit, as are TIME, JSON, ENUM and SET columns.
+    """
+    fields = []
+    for column in column_descriptions:
+        column_name, type_code, flags = column[0], column[1], column[7]
+        if len(column) > 8:
+            is_binary = column[8] == BINARY_CHARACTER_SET
+        else:
+            is_binary = bool(flags & FieldFlag.BINARY)
+        if type_code in MYSQL_INTEGER_TYPES:
+            field_type = pa.uint64() if flags & FieldFlag.UNSIGNED \
+                else pa.int64()
+        elif type_code in (FieldType.FLOAT, FieldType.DOUBLE):
+            field_type = pa.float64()
+        elif type_code in (FieldType.DATE, FieldType.NEWDATE):
+            field_type = pa.date32()
+        elif type_code in (FieldType.DATETIME, FieldType.TIMESTAMP):
+            field_type = pa.timestamp('us')
+        elif type_code in MYSQL_BINARY_TYPES and is_binary:
+            field_type = pa.binary()
+        else:
+            field_type = pa.string()
+        fields.append(pa.field(column_name, field_type))
+    return pa.schema(fields)
+
+
+def convert_to_string(value):
+    """
+    Render a value from the cursor as the string stored in the parquet file.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, set):
+        return ','.join(sorted(value))
+    return str(value)
+
+
+def convert_to_bytes(value):
+    """
+    Render a value from the cursor as the bytes stored in the parquet file.
+    """
+    if value is None or isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+def create_cursor_array(values, field_type):
+    """
+    Convert one column of a batch of rows to an Arrow array of the type
+    taken from the cursor description.
+    """
+    if field_type == pa.string():
+        values = [convert_to_string(value) for value in values]
+    elif field_type == pa.binary():
+        values = [convert_to_bytes(value) for value in values]
+    return pa.array(values, type=field_type)
+
+
+def create_parquet_with_cursor(query, db_connection, destination_file_path,
+                               row_group_size=10000, compression='snappy'):
+    """
+    Read in data from a SQL query with an unbuffered cursor and write each
+    batch of rows to a parquet file as its own row group, converting rows
+    straight to Arrow columns without building DataFrames.
+    """
+    start_time = time.time()
+    row_count = 0
+    writer = None
+    try:
+        batches = fetch_with_cursor(query, db_connection, row_group_size)
+        schema = create_cursor_schema(next(batches))
+        writer = pq.ParquetWriter(destination_file_path, schema,
+                                  compression=compression)
+        for rows in batches:
+            table = pa.Table.from_arrays(
+                [create_cursor_array(column, field.type)
+                 for column, field in zip(zip(*rows), schema)],
+                schema=schema)
+            writer.write_table(table)
+            row_count += len(rows)
+    finally:
+        if writer:
+            writer.close()
+    print_throughput(row_count, start_time)
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows.')
+    return row_count
+
+
+def store_query_results(query, db_connection, destination_file_path,
+                        file_header=True, destination_file_format='csv',
+                        export_method='pandas', compression='none',
+                        row_group_size=10000, parquet_compression='snappy',
+                        fetch_size=10000):
+    """
+    Store the results of a query with the requested file format and export
+    method.
+    """
+    if destination_file_format == 'parquet' and export_method == 'cursor':
+        create_parquet_with_cursor(
+            query=query,
+            db_connection=db_connection,
+            destination_file_path=destination_file_path,
+            row_group_size=row_group_size,
+            compression=parquet_compression)
+    elif destination_file_format == 'parquet':
+        create_parquet(
+            query=text(query),
+            db_connection=db_connection,
+            destination_file_path=destination_file_path,
+            row_group_size=row_group_size,
+            compression=parquet_compression)
+    elif export_method == 'cursor':
+        create_csv_with_cursor(
+            query=query,
+            db_connection=db_connection,
+            destination_file_path=destination_file_path,
+            file_header=file_header,
+            compression=compression,
+            fetch_size=fetch_size)
+    else:
+        create_csv(
+            query=text(query),
+            db_connection=db_connection,
+            destination_file_path=destination_file_path,
+            file_header=file_header,
+            compression=compression)
+
+
+def enumerate_destination_file_name(destination_full_path, file_number=1):
+    """
+    Append a number to the end of the provided destination file name.
+    Used to name the part files written by each partition.
+    """
+    folder_name, file_name = os.path.split(destination_full_path)
+    if re.search(r'\.', file_name):
+        file_name = re.sub(r'\.', f'_{file_number}.', file_name, 1)
+    else:
+        file_name = f'{file_name}_{file_number}'
+    return os.path.join(folder_name, file_name)
+
+
+def format_partition_bound(value):
+    """
+    Render a partition boundary as a SQL literal. Dates and timestamps are
+    quoted so the database casts them back to the column's type.
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return f"'{value}'"
+    return str(value)
+
+
+def create_partition_queries(query, partition_column, partition_count,
+                             db_connection):
+    """
+    Split the query into partition_count queries over equally wide ranges
+    of partition_column, which must be numeric, a date or a timestamp. Rows
+    where the column is NULL are included in the first partition.
+    """
+    query = query.strip().rstrip(';')
+    with db_connection.connect() as connection:
+        lower_bound, upper_bound = connection.execute(text(
+            f'SELECT MIN({partition_column}), MAX({partition_column}) '
+            f'FROM ({query}) AS partition_source')).fetchone()
+    if lower_bound is None:
+        return [query]
+
+    width = (upper_bound - lower_bound) / partition_count
+    boundaries = [format_partition_bound(lower_bound + width * index)
+                  for index in range(1, partition_count)]
+
+    predicates = [f'{partition_column} < {boundaries[0]} '
+                  f'OR {partition_column} IS NULL']
+    for lower, upper in zip(boundaries, boundaries[1:]):
+        predicates.append(f'{partition_column} >= {lower} '
+                          f'AND {partition_column} < {upper}')
+    predicates.append(f'{partition_column} >= {boundaries[-1]}')
+
+    return [f'SELECT * FROM ({query}) AS partitioned_query WHERE ({predicate})'
+            for predicate in predicates]
+
+
+def get_column_names(query, db_connection):
+    """
+    Return the column names of the query without fetching any rows.
+    """
+    query = query.strip().rstrip(';')
+    with db_connection.connect() as connection:
+        result = connection.execute(text(
+            f'SELECT * FROM ({query}) AS column_source LIMIT 0'))
+        column_names = list(result.keys())
+        result.close()
+    return column_names
+
+
+def create_csv_header(column_names, destination_file_path,
+                      compression='none'):
+    """
+    Write a csv holding only the header, compressed the same way as the
+    part files so it can be concatenated in front of them.
+    """
+    destination_file = open_destination_file(destination_file_path,
+                                             compression)
+    try:
+        pd.DataFrame(columns=column_names).to_csv(destination_file,
+                                                  index=False)
+    finally:
+        close_destination_file(destination_file, destination_file_path)
+
+
+def merge_partition_files(partition_file_paths, destination_full_path,
+                          destination_file_format='csv',
+                          header_file_path=None):
+    """
+    Combine the part files, in partition order, into a single file and
+    remove the parts. CSV parts, compressed or not, are concatenated byte
+    for byte, after the header file when there is one. Parquet parts are
+    copied over one row group at a time.
+    """
+    partition_file_paths = [file_path for file_path in partition_file_paths
+                            if os.path.exists(file_path)]
+    if destination_file_format == 'parquet':
+        writer = None
+        try:
+            for file_path in partition_file_paths:
+                parquet_file = pq.ParquetFile(file_path)
+                if not writer:
+                    schema = create_merged_schema(partition_file_paths)
+                    writer = pq.ParquetWriter(destination_full_path, schema)
+                for row_group in range(parquet_file.num_row_groups):
+                    writer.write_table(cast_table(
+                        parquet_file.read_row_group(row_group), schema))
+        finally:
+            if writer:
+                writer.close()
+    else:
+        with open(destination_full_path, 'wb') as destination_file:
+            for file_path in [header_file_path] + partition_file_paths:
+                if not file_path:
+                    continue
+                with open(file_path, 'rb') as partition_file:
+                    shutil.copyfileobj(partition_file, destination_file,
+                                       1048576)
+        if header_file_path:
+            os.remove(header_file_path)
+
+    for file_path in partition_file_paths:
+        os.remove(file_path)
+    print(f'Merged {len(partition_file_paths)} partitions into '
+          f'{destination_full_path}.')
+
+
+def create_partitioned_files(query, db_connection, destination_full_path,
+                             partition_column, partition_count,
+                             merge_files=True, file_header=True,
+                             export_options=None):
+    """
+    Run one bounded query per partition concurrently, each on its own
+    connection, and write every partition to its own part file. The parts
+    are merged in order into destination_full_path when merge_files is set.
+    """
+    partition_queries = create_partition_queries(
+        query, partition_column, partition_count, db_connection)
+    partition_file_paths = [
+        enumerate_destination_file_name(destination_full_path, index + 1)
+        for index in range(len(partition_queries))]
+    print(f'Extracting {len(partition_queries)} partitions of '
+          f'{partition_column} concurrently.')
+
+    with ThreadPoolExecutor(max_workers=len(partition_queries)) as executor:
+        futures = [
+            executor.submit(
+                store_query_results,
+                query=partition_query,
+                db_connection=db_connection,
+                destination_file_path=file_path,
+                file_header=file_header and not merge_files,
+                **(export_options or {}))
+            for partition_query, file_path in zip(
+                partition_queries, partition_file_paths)]
+        for future in futures:
+            future.result()
+
+    if merge_files:
+        destination_file_format = (export_options or {}).get(
+            'destination_file_format', 'csv')
+        header_file_path = None
+        if destination_file_format == 'csv' and file_header:
+            # The header is written from the column names rather than taken
+            # from the first partition, which may have come back empty.
+            header_file_path = enumerate_destination_file_name(
+                destination_full_path, 0)
+            create_csv_header(
+                get_column_names(query, db_connection), header_file_path,
+                (export_options or {}).get('compression', 'none'))
+        merge_partition_files(
+            partition_file_paths, destination_full_path,
+            destination_file_format, header_file_path)
+
+
+def format_watermark(value):
+    """
+    Render a high-water mark as a SQL literal. Dates, timestamps and
+    strings are quoted so the database casts them back to the column's
+    type. Trailing zeros are dropped from fractional seconds, since some
+    timestamp types accept fewer than six digits. Any UTC offset is kept
+    as it is.
+    """
+    if isinstance(value, datetime.datetime):
+        timestamp = value.replace(tzinfo=None).isoformat(sep=' ')
+        utc_offset = value.isoformat(sep=' ')[len(timestamp):]
+        if '.' in timestamp:
+            timestamp = timestamp.rstrip('0').rstrip('.')
+        value = timestamp + utc_offset
+    if isinstance(value, (datetime.date, str)):
+        escaped_value = str(value).replace("'", "''")
+        return f"'{escaped_value}'"
+    return str(value)
+
+
+def create_state_key(query, incremental_column):
+    """
+    Key the stored high-water mark on the query and column it belongs to,
+    so several extracts can share one state file.
+    """
+    key = json.dumps([query.strip().rstrip(';'), incremental_column])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def read_incremental_state(incremental_state_file):
+    """
+    Read the high-water marks saved by previous runs.
+    """
+    if not os.path.exists(incremental_state_file):
+        return {}
+    with open(incremental_state_file, 'r') as state_file:
+        return json.load(state_file)
+
+
+def write_incremental_state(incremental_state, incremental_state_file):
+    """
+    Replace the state file in one step, so an interrupted run can't leave
+    it half written.
+    """
+    temporary_file_name = f'{incremental_state_file}.tmp'
+    with open(temporary_file_name, 'w') as state_file:
+        json.dump(incremental_state, state_file, indent=2)
+    os.replace(temporary_file_name, incremental_state_file)
+
+
+def get_upper_watermark(query, incremental_column, db_connection):
+    """
+    Find the current high-water mark of the column before extracting, so
+    this run has a fixed upper bound.
+    """
+    query = query.strip().rstrip(';')
+    with db_connection.connect() as connection:
+        value = connection.execute(text(
+            f'SELECT MAX({incremental_column}) '
+            f'FROM ({query}) AS incremental_source')).scalar()
+    return None if value is None else format_watermark(value)
+
+
+def create_incremental_query(query, incremental_column, lower_watermark,
+                             upper_watermark):
+    """
+    Limit the query to rows after the previous run's high-water mark, up to
+    the mark taken at the start of this run. Rows that arrive while the
+    extract runs are left for the next run rather than being split across
+    two of them.
+    """
+    query = query.strip().rstrip(';')
+    predicate = f'{incremental_column} <= {upper_watermark}'
+    if lower_watermark is not None:
+        predicate = f'{incremental_column} > {lower_watermark} AND {predicate}'
+    return f'SELECT * FROM ({query}) AS incremental_query WHERE {predicate}'
+
+
+def append_incremental_file(new_file_path, destination_full_path,
+                            destination_file_format='csv'):
+    """
+    Add the rows extracted by this run to the end of the existing output.
+    CSV files, compressed or not, are appended byte for byte, since only
+    the first run writes a header. Parquet can't be appended to in place,
+    so the existing row groups and the new ones are copied into a fresh
+    file that replaces the old one.
+    """
+    if not os.path.exists(new_file_path):
+        return
+    if not os.path.exists(destination_full_path):
+        os.replace(new_file_path, destination_full_path)
+        return
+
+    if destination_file_format == 'parquet':
+        merged_file_path = f'{destination_full_path}.tmp'
+        schema = create_merged_schema(
+            [destination_full_path, new_file_path])
+        writer = pq.ParquetWriter(merged_file_path, schema)
+        try:
+            for file_path in (destination_full_path, new_file_path):
+                parquet_file = pq.ParquetFile(file_path)
+                for row_group in range(parquet_file.num_row_groups):
+                    writer.write_table(cast_table(
+                        parquet_file.read_row_group(row_group), schema))
+        finally:
+            writer.close()
+        os.replace(merged_file_path, destination_full_path)
+    else:
+        with open(destination_full_path, 'ab') as destination_file:
+            with open(new_file_path, 'rb') as new_file:
+                shutil.copyfileobj(new_file, destination_file, 1048576)
+    os.remove(new_file_path)
+
+
 def main():
     args = get_args()
     username = args.username
@@ -75,22 +820,85 @@ def main():
     destination_full_path = combine_folder_and_file_name(
         folder_name=destination_folder_name, file_name=destination_file_name)
     file_header = convert_to_boolean(args.file_header)
-    query = text(args.query)
+    destination_file_format = args.destination_file_format
+    parquet_compression = args.parquet_compression
+    compression = args.compression
+    row_group_size = int(args.row_group_size)
+    partition_column = args.partition_column
+    partition_count = int(args.partition_count)
+    merge_files = convert_to_boolean(args.merge_files)
+    export_method = args.export_method
+    fetch_size = int(args.fetch_size)
+    query = args.query
+    incremental_column = args.incremental_column
+    incremental_state_file = args.incremental_state_file
 
     db_string = f'mysql+mysqlconnector://{username}:{password}@{host}:{port}/{database}?{url_parameters}'
     db_connection = create_engine(
-        db_string, pool_recycle=3600, execution_options=dict(
-            stream_results=True))
+        db_string, pool_recycle=3600, pool_size=max(partition_count, 5),
+        execution_options=dict(stream_results=True))
 
     if not os.path.exists(destination_folder_name) and (
             destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    create_csv(
-        query=query,
-        db_connection=db_connection,
-        destination_file_path=destination_full_path,
-        file_header=file_header)
+    if destination_file_format == 'csv':
+        destination_full_path = add_compression_extension(
+            destination_full_path, compression)
+
+    if incremental_column:
+        incremental_state = read_incremental_state(incremental_state_file)
+        state_key = create_state_key(query, incremental_column)
+        lower_watermark = incremental_state.get(state_key)
+        upper_watermark = get_upper_watermark(
+            query, incremental_column, db_connection)
+        if upper_watermark is None or upper_watermark == lower_watermark:
+            print(f'No new rows since {incremental_column} reached '
+                  f'{lower_watermark}.')
+            return
+        query = create_incremental_query(
+            query, incremental_column, lower_watermark, upper_watermark)
+        # New rows are extracted to a side file, then appended to the
+        # existing output once the extract has succeeded.
+        output_full_path = destination_full_path
+        destination_full_path = f'{output_full_path}.incremental'
+        file_header = file_header and not os.path.exists(output_full_path)
+        # Separate part files can't be appended to the output.
+        merge_files = True
+
+    export_options = dict(
+        destination_file_format=destination_file_format,
+        export_method=export_method,
+        compression=compression,
+        row_group_size=row_group_size,
+        parquet_compression=parquet_compression,
+        fetch_size=fetch_size)
+
+    if partition_column and partition_count > 1:
+        create_partitioned_files(
+            query=query,
+            db_connection=db_connection,
+            destination_full_path=destination_full_path,
+            partition_column=partition_column,
+            partition_count=partition_count,
+            merge_files=merge_files,
+            file_header=file_header,
+            export_options=export_options)
+    else:
+        store_query_results(
+            query=query,
+            db_connection=db_connection,
+            destination_file_path=destination_full_path,
+            file_header=file_header,
+            **export_options)
+
+    if incremental_column:
+        append_incremental_file(
+            destination_full_path, output_full_path, destination_file_format)
+        incremental_state[state_key] = upper_watermark
+        write_incremental_state(incremental_state, incremental_state_file)
+        print(f'Appended rows up to {incremental_column} {upper_watermark} '
+              f'to {output_full_path}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,247 @@
+from sqlalchemy import create_engine
+from psycopg2 import sql
+import argparse
+import io
+import os
+import glob
+import random
+import re
+import csv
+import time
+import pandas as pd
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--username', dest='username', required=True)
+    parser.add_argument('--password', dest='password', required=False)
+    parser.add_argument('--host', dest='host', required=True)
+    parser.add_argument('--database', dest='database', required=True)
+    parser.add_argument('--port', dest='port', default='5432', required=False)
+    parser.add_argument('--url-parameters',
+                        dest='url_parameters', required=False)
+    parser.add_argument('--source-file-name-match-type',
+                        dest='source_file_name_match_type',
+                        choices={
+                            'exact_match',
+                            'regex_match'},
+                        required=True)
+    parser.add_argument('--source-file-name', dest='source_file_name',
+                        default='output.csv', required=True)
+    parser.add_argument('--source-folder-name',
+                        dest='source_folder_name', default='', required=False)
+    parser.add_argument('--table-name', dest='table_name', default=None,
+                        required=True)
+    parser.add_argument('--insert-method', dest='insert_method', choices={'fail', 'replace', 'append'}, default='append',
+                        required=False)
+    parser.add_argument('--buffer-size', dest='buffer_size', default='8388608',
+                        required=False)
+    args = parser.parse_args()
+    return args
+
+
+def convert_to_boolean(string):
+    """
+    Shipyard can't support passing Booleans to code, so we have to convert
+    string values to their boolean values.
+    """
+    if string in ['True', 'true', 'TRUE']:
+        value = True
+    else:
+        value = False
+    return value
+
+
+def find_all_local_file_names(source_folder_name):
+    """
+    Returns a list of all files that exist in the current working directory,
+    filtered by source_folder_name if provided.
+    """
+    cwd = os.getcwd()
+    cwd_extension = os.path.normpath(f'{cwd}/{source_folder_name}/**')
+    file_names = glob.glob(cwd_extension, recursive=True)
+    return [file_name for file_name in file_names if os.path.isfile(file_name)]
+
+
+def find_all_file_matches(file_names, file_name_re):
+    """
+    Return a list of all file_names that matched the regular expression.
+    """
+    matching_file_names = []
+    for file in file_names:
+        if re.search(file_name_re, file):
+            matching_file_names.append(file)
+
+    return matching_file_names
+
+
+def combine_folder_and_file_name(folder_name, file_name):
+    """
+    Combine together the provided folder_name and file_name into one path variable.
+    """
+    combined_name = os.path.normpath(
+        f'{folder_name}{"/" if folder_name else ""}{file_name}')
+
+    return combined_name
+
+
+def read_file_header(source_full_path):
+    """
+    Return the column names listed in the first line of the csv.
+    """
+    with open(source_full_path, 'r', newline='') as source_file:
+        return next(csv.reader(source_file))
+
+
+def read_sample(source_full_path, sample_size=10000, seek_count=10):
+    """
+    Read a sample of the file as strings: the first sample_size rows, plus
+    sample_size / seek_count rows from each of seek_count random offsets,
+    so values that only appear further into the file are seen too. Windows
+    that start inside a quoted value can't be parsed and are skipped.
+    """
+    samples = [pd.read_csv(source_full_path, nrows=sample_size, dtype=str)]
+    file_size = os.path.getsize(source_full_path)
+    with open(source_full_path, 'rb') as source_file:
+        header = source_file.readline().decode('utf-8')
+        offsets = random.sample(range(file_size), min(seek_count, file_size))
+        for offset in sorted(offsets):
+            source_file.seek(offset)
+            # Skip the rest of the line the offset landed in.
+            source_file.readline()
+            lines = b''.join(source_file.readline()
+                             for _ in range(sample_size // seek_count))
+            try:
+                window = pd.read_csv(
+                    io.StringIO(header + lines.decode('utf-8', 'replace')),
+                    dtype=str)
+            except Exception:
+                continue
+            if list(window.columns) == list(samples[0].columns):
+                samples.append(window)
+    return pd.concat(samples, ignore_index=True)
+
+
+def infer_column_types(sample):
+    """
+    Pick one Postgres type per column from the sampled strings. Whole
+    numbers become BIGINT, other numbers NUMERIC and true/false values
+    BOOLEAN. Everything else, including columns that are empty in the
+    sample, is stored as TEXT, which accepts any value the rest of the
+    file might hold.
+    """
+    column_types = {}
+    for column_name in sample.columns:
+        values = sample[column_name].dropna().str.strip()
+        if values.empty:
+            column_types[column_name] = 'TEXT'
+        elif values.str.lower().isin(['true', 'false']).all():
+            column_types[column_name] = 'BOOLEAN'
+        elif values.str.match(r'^[+-]?\d{1,18}$').all():
+            column_types[column_name] = 'BIGINT'
+        elif values.str.match(
+                r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$').all():
+            column_types[column_name] = 'NUMERIC'
+        else:
+            column_types[column_name] = 'TEXT'
+    return column_types
+
+
+def prepare_table(source_full_path, table_name, insert_method, connection):
+    """
+    Make sure the target table exists before COPY runs, since COPY can't
+    create tables. Missing tables are created from the column types
+    inferred on a sample taken from across the file. Runs inside the
+    caller's transaction, so a replaced table is only visible once the new
+    data is committed.
+    """
+    table_exists = connection.dialect.has_table(connection, table_name)
+    if table_exists and insert_method == 'fail':
+        raise ValueError(f'Table {table_name} already exists.')
+    if table_exists and insert_method == 'append':
+        return
+
+    column_types = infer_column_types(read_sample(source_full_path))
+    cursor = connection.connection.cursor()
+    cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(
+        sql.Identifier(table_name)))
+    cursor.execute(sql.SQL('CREATE TABLE {} ({})').format(
+        sql.Identifier(table_name),
+        sql.SQL(', ').join(
+            sql.SQL('{} {}').format(sql.Identifier(column_name),
+                                    sql.SQL(column_type))
+            for column_name, column_type in column_types.items())))
+    cursor.close()
+
+
+def upload_data(source_full_path, table_name, insert_method, db_connection,
+                buffer_size=8388608):
+    """
+    Stream a csv into Postgres with COPY FROM STDIN, straight into the
+    target table. Every file is loaded in a single transaction, so a failed
+    load leaves the table untouched without needing a staging table.
+    """
+    column_names = read_file_header(source_full_path)
+    columns = sql.SQL(', ').join(
+        sql.Identifier(column_name) for column_name in column_names)
+
+    start_time = time.time()
+    with db_connection.begin() as connection:
+        prepare_table(source_full_path, table_name, insert_method, connection)
+        cursor = connection.connection.cursor()
+        copy_statement = sql.SQL('COPY {} ({}) FROM STDIN WITH CSV HEADER').format(
+            sql.Identifier(table_name), columns)
+        with open(source_full_path, 'r', newline='') as source_file:
+            cursor.copy_expert(copy_statement.as_string(cursor), source_file,
+                               size=buffer_size)
+        row_count = cursor.rowcount
+        cursor.close()
+
+    elapsed_time = max(time.time() - start_time, 0.001)
+    print(
+        f'Loaded {row_count} rows in {elapsed_time:.2f} seconds '
+        f'({row_count / elapsed_time:.0f} rows/sec).')
+
+
+def main():
+    args = get_args()
+    username = args.username
+    password = args.password
+    host = args.host
+    database = args.database
+    port = args.port
+    source_file_name_match_type = args.source_file_name_match_type
+    source_file_name = args.source_file_name
+    source_folder_name = args.source_folder_name
+    source_full_path = combine_folder_and_file_name(
+        folder_name=source_folder_name, file_name=source_file_name)
+    url_parameters = args.url_parameters
+    table_name = args.table_name
+    insert_method = args.insert_method
+    buffer_size = int(args.buffer_size)
+
+    db_string = f'postgresql://{username}:{password}@{host}:{port}/{database}?{url_parameters}'
+    db_connection = create_engine(db_string)
+
+    if source_file_name_match_type == 'regex_match':
+        file_names = find_all_local_file_names(source_folder_name)
+        matching_file_names = find_all_file_matches(
+            file_names, re.compile(source_file_name))
+        print(f'{len(matching_file_names)} files found. Preparing to upload...')
+
+        for index, key_name in enumerate(matching_file_names):
+            # Only the first file should replace or check for the table,
+            # every file after it is added to what was just loaded.
+            upload_data(source_full_path=key_name, table_name=table_name,
+                        insert_method=insert_method if index == 0 else 'append',
+                        db_connection=db_connection, buffer_size=buffer_size)
+            print(f'{key_name} has been uploaded to {table_name}.')
+
+    else:
+        upload_data(source_full_path=source_full_path, table_name=table_name,
+                    insert_method=insert_method, db_connection=db_connection,
+                    buffer_size=buffer_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,22 @@
 import argparse
+import bz2
+import gzip
+import io
+import json
+import datetime
+import hashlib
 import os
-import code
+import re
 import csv
+import shutil
+import uuid
+import boto3
 import pandas as pd
+import zstandard
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
 
 
 def get_args():
@@ -24,7 +37,50 @@ def get_args():
         '--url-parameters',
         dest='url_parameters',
         required=False)
+    parser.add_argument('--destination-file-format',
+                        dest='destination_file_format',
+                        choices={'csv', 'parquet'}, default='csv',
+                        required=False)
+    parser.add_argument('--parquet-compression', dest='parquet_compression',
+                        choices={'snappy', 'gzip', 'brotli', 'zstd', 'none'},
+                        default='snappy', required=False)
+    parser.add_argument('--row-group-size', dest='row_group_size',
+                        default='10000', required=False)
+    parser.add_argument('--compression', dest='compression',
+                        choices={'none', 'gzip', 'zstd', 'bz2'},
+                        default='none', required=False)
+    parser.add_argument('--export-method', dest='export_method',
+                        choices={'pandas', 'unload'}, default='pandas',
+                        required=False)
+    parser.add_argument('--s3-bucket-name', dest='s3_bucket_name',
+                        required=False)
+    parser.add_argument('--s3-folder-name', dest='s3_folder_name', default='',
+                        required=False)
+    parser.add_argument('--iam-role', dest='iam_role', required=False)
+    parser.add_argument('--merge-files', dest='merge_files', default='True',
+                        required=False)
+    parser.add_argument('--max-workers', dest='max_workers', default='8',
+                        required=False)
+    parser.add_argument('--keep-unload-files', dest='keep_unload_files',
+                        default='False', required=False)
+    parser.add_argument('--s3-endpoint-url', dest='s3_endpoint_url',
+                        default=None, required=False)
+    parser.add_argument('--aws-access-key-id', dest='aws_access_key_id',
+                        required=False)
+    parser.add_argument('--aws-secret-access-key',
+                        dest='aws_secret_access_key', required=False)
+    parser.add_argument('--aws-default-region', dest='aws_default_region',
+                        required=False)
+    parser.add_argument('--incremental-column', dest='incremental_column',
+                        default=None, required=False)
+    parser.add_argument('--incremental-state-file',
+                        dest='incremental_state_file',
+                        default='incremental_state.json', required=False)
     args = parser.parse_args()
+    if args.export_method == 'unload' and (
+            args.s3_bucket_name is None or args.iam_role is None):
+        parser.error(
+            '--export-method unload requires --s3-bucket-name and --iam-role')
     return args
 
 
@@ -50,21 +106,543 @@ def combine_folder_and_file_name(folder_name, file_name):
     return combined_name
 
 
-def create_csv(query, db_connection, destination_full_path):
+def add_compression_extension(destination_full_path, compression):
+    """
+    Add the file extension matching the compression method, unless the
+    provided file name already ends with it.
+    """
+    extension = {'gzip': '.gz', 'bz2': '.bz2', 'zstd': '.zst'}.get(compression)
+    if extension and not destination_full_path.endswith(extension):
+        destination_full_path = f'{destination_full_path}{extension}'
+    return destination_full_path
+
+
+def open_destination_file(destination_file_path, compression='none',
+                          buffer_size=8388608):
+    """
+    Open the destination file once for the whole extract, with a large write
+    buffer. Rows are compressed as they are written when a compression
+    method is provided, so the uncompressed file never touches disk. Any
+    file left behind by a previous run is truncated rather than appended to.
+    """
+    if compression == 'gzip':
+        binary_file = gzip.open(destination_file_path, 'wb')
+    elif compression == 'bz2':
+        binary_file = bz2.open(destination_file_path, 'wb')
+    elif compression == 'zstd':
+        # threads=-1 spreads compression across every available core.
+        binary_file = zstandard.ZstdCompressor(threads=-1).stream_writer(
+            open(destination_file_path, 'wb', buffering=buffer_size))
+    else:
+        binary_file = open(destination_file_path, 'wb', buffering=buffer_size)
+    return io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+
+
+def close_destination_file(destination_file, destination_file_path):
+    """
+    Close the destination file, writing out any buffered or compressed data,
+    and fsync it once every row has been written. Returns the number of
+    bytes written.
+    """
+    destination_file.close()
+    file_descriptor = os.open(destination_file_path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+    return os.path.getsize(destination_file_path)
+
+
+def create_csv(query, db_connection, destination_full_path, file_header=True,
+               compression='none'):
     """
     Read in data from a SQL query. Store the data as a csv.
     """
-    i = 1
-    for chunk in pd.read_sql_query(query, db_connection, chunksize=10000):
-        if i == 1:
-            chunk.to_csv(destination_full_path, mode='a', index=False)
-        else:
-            chunk.to_csv(destination_full_path, mode='a', index=False)
-        i += 1
-    print(f'Successfully stored results as {destination_full_path}.')
+    row_count = 0
+    destination_file = open_destination_file(destination_full_path, compression)
+    try:
+        for chunk_number, chunk in enumerate(
+                pd.read_sql_query(query, db_connection, chunksize=10000)):
+            chunk.to_csv(destination_file, index=False,
+                         header=file_header if chunk_number == 0 else False)
+            row_count += len(chunk)
+    finally:
+        byte_count = close_destination_file(
+            destination_file, destination_full_path)
+    print(f'Successfully stored {row_count} rows ({byte_count} bytes) as '
+          f'{destination_full_path}.')
+    return row_count, byte_count
+
+
+def promote_arrow_types(field_types):
+    """
+    Pick one type that values of every type in field_types can be stored as.
+    Nulls take the type of the other values, integers mixed with floats
+    become floats and decimals are widened to fit every precision and
+    scale. Any other mix is stored as strings. Columns with nothing but
+    nulls stay null, so a later chunk can still give them a real type.
+    """
+    field_types = [field_type for field_type in field_types
+                   if field_type != pa.null()]
+    if not field_types:
+        return pa.null()
+    if all(field_type == field_types[0] for field_type in field_types):
+        return field_types[0]
+    if all(pa.types.is_integer(field_type) for field_type in field_types):
+        return pa.int64()
+    if all(pa.types.is_integer(field_type) or pa.types.is_floating(field_type)
+           for field_type in field_types):
+        return pa.float64()
+    if all(pa.types.is_decimal(field_type) for field_type in field_types):
+        scale = max(field_type.scale for field_type in field_types)
+        integer_digits = max(field_type.precision - field_type.scale
+                             for field_type in field_types)
+        return pa.decimal128(min(integer_digits + scale, 38), scale)
+    return pa.string()
+
+
+def promote_schemas(schemas):
+    """
+    Build one schema that tables with every schema in schemas can be cast
+    to. Fields are kept in the order of the first schema.
+    """
+    field_types = [dict(zip(schema.names, schema.types))
+                   for schema in schemas]
+    return pa.schema([
+        pa.field(field_name, promote_arrow_types(
+            [types[field_name] for types in field_types
+             if field_name in types]))
+        for field_name in schemas[0].names])
+
+
+def create_merged_schema(file_paths):
+    """
+    Build one schema that every parquet file in file_paths can be cast to,
+    rather than assuming the types of the first file hold for all of them.
+    """
+    return promote_schemas(
+        [pq.read_schema(file_path) for file_path in file_paths])
+
+
+def cast_table(table, schema):
+    """
+    Cast every column of the table to the type in the schema. Columns that
+    Arrow can't cast directly are converted through their Python values.
+    """
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if column.type != field.type:
+            try:
+                column = column.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                values = column.to_pylist()
+                if field.type == pa.string():
+                    values = [None if value is None else str(value)
+                              for value in values]
+                column = pa.array(values, type=field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def widen_parquet_file(writer, destination_file_path, schema, compression):
+    """
+    Rewrite the row groups already written to destination_file_path with
+    the wider schema, then return a writer that appends with that schema.
+    Parquet files have one schema, so this is the only way to widen a
+    column after its first row group.
+    """
+    writer.close()
+    previous_file_path = f'{destination_file_path}.tmp'
+    os.replace(destination_file_path, previous_file_path)
+    previous_file = pq.ParquetFile(previous_file_path)
+    writer = pq.ParquetWriter(destination_file_path, schema,
+                              compression=compression)
+    for row_group in range(previous_file.num_row_groups):
+        writer.write_table(cast_table(
+            previous_file.read_row_group(row_group), schema))
+    os.remove(previous_file_path)
+    return writer
+
+
+def write_parquet_chunk(writer, schema, table, destination_file_path,
+                        compression='snappy', row_group_size=10000):
+    """
+    Write one chunk of results to the parquet file, opening the writer on
+    the first chunk. The first chunk can't know every type, since a column
+    can be null or hold narrower decimals until later, so the schema is
+    widened whenever a chunk doesn't fit it. Returns the writer and the
+    schema to pass along with the next chunk.
+    """
+    if not writer:
+        schema = promote_schemas([table.schema])
+        writer = pq.ParquetWriter(destination_file_path, schema,
+                                  compression=compression)
+    else:
+        wider_schema = promote_schemas([schema, table.schema])
+        if not wider_schema.equals(schema):
+            schema = wider_schema
+            writer = widen_parquet_file(writer, destination_file_path,
+                                        schema, compression)
+    writer.write_table(cast_table(table, schema),
+                       row_group_size=row_group_size)
+    return writer, schema
+
+
+def create_parquet(query, db_connection, destination_file_path,
+                   row_group_size=10000, compression='snappy'):
+    """
+    Read in data from a SQL query. Store the data as a parquet file, writing
+    each chunk as its own row group so the full result is never held in
+    memory.
+    """
+    writer = None
+    schema = None
+    try:
+        for chunk in pd.read_sql_query(query, db_connection,
+                                       chunksize=row_group_size):
+            writer, schema = write_parquet_chunk(
+                writer, schema,
+                pa.Table.from_pandas(chunk, preserve_index=False),
+                destination_file_path, compression, row_group_size)
+    finally:
+        if writer:
+            writer.close()
+    print(f'{destination_file_path} was successfully created.')
     return
 
 
+def set_environment_variables(args):
+    """
+    Set AWS credentials as environment variables if they're provided via keyword arguments
+    rather than seeded as environment variables. This will override system defaults.
+    """
+
+    if args.aws_access_key_id:
+        os.environ['AWS_ACCESS_KEY_ID'] = args.aws_access_key_id
+    if args.aws_secret_access_key:
+        os.environ['AWS_SECRET_ACCESS_KEY'] = args.aws_secret_access_key
+    if args.aws_default_region:
+        os.environ['AWS_DEFAULT_REGION'] = args.aws_default_region
+    return
+
+
+def connect_to_s3(s3_endpoint_url=None):
+    """
+    Create a connection to the S3 service using credentials provided as
+    environment variables. s3_endpoint_url points the client at an S3
+    compatible service instead of AWS.
+    """
+    s3_connection = boto3.client('s3', endpoint_url=s3_endpoint_url)
+    return s3_connection
+
+
+def enumerate_destination_file_name(destination_full_path, file_number=1):
+    """
+    Append a number to the end of the provided destination file name.
+    Used to name the slice files when they aren't merged together.
+    """
+    folder_name, file_name = os.path.split(destination_full_path)
+    if re.search(r'\.', file_name):
+        file_name = re.sub(r'\.', f'_{file_number}.', file_name, 1)
+    else:
+        file_name = f'{file_name}_{file_number}'
+    return os.path.join(folder_name, file_name)
+
+
+def get_column_names(query, db_connection):
+    """
+    Return the column names the query produces, without fetching any rows.
+    """
+    with db_connection.connect() as connection:
+        result = connection.execute(text(
+            f'SELECT * FROM ({query}) AS unload_query LIMIT 0'))
+        column_names = list(result.keys())
+        result.close()
+    return column_names
+
+
+def unload_query(query, db_connection, s3_connection, s3_bucket_name,
+                 s3_prefix, iam_role, destination_file_format='csv',
+                 compression='none', file_header=True):
+    """
+    UNLOAD the results of the query to S3, with every slice of the cluster
+    writing its own files in parallel. Returns the object keys of the files,
+    read from the manifest Redshift writes alongside them.
+    """
+    query = query.strip().rstrip(';').replace("'", "''")
+    if destination_file_format == 'parquet':
+        format_options = 'FORMAT AS PARQUET'
+    else:
+        format_options = 'FORMAT AS CSV'
+        if file_header:
+            format_options += ' HEADER'
+        if compression != 'none':
+            format_options += ' ' + {
+                'gzip': 'GZIP', 'bz2': 'BZIP2', 'zstd': 'ZSTD'}[compression]
+
+    try:
+        with db_connection.begin() as connection:
+            connection.execute(text(
+                f"UNLOAD ('{query}') TO 's3://{s3_bucket_name}/{s3_prefix}' "
+                f"IAM_ROLE '{iam_role}' {format_options} "
+                'PARALLEL ON MANIFEST'))
+    except Exception as e:
+        print(f'Failed to unload query results to s3://{s3_bucket_name}/{s3_prefix}')
+        raise(e)
+
+    manifest = s3_connection.get_object(
+        Bucket=s3_bucket_name, Key=f'{s3_prefix}manifest')
+    entries = json.loads(manifest['Body'].read())['entries']
+    object_keys = [entry['url'].split('/', 3)[3] for entry in entries]
+    print(f'Successfully unloaded query results to {len(object_keys)} files '
+          f'in s3://{s3_bucket_name}/{s3_prefix}')
+    return object_keys
+
+
+def download_unload_files(s3_connection, s3_bucket_name, object_keys,
+                          destination_file_paths, max_workers=8):
+    """
+    Download the unloaded files concurrently.
+    """
+    def download_file(object_key, destination_file_path):
+        s3_connection.download_file(
+            s3_bucket_name, object_key, destination_file_path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_file, object_key, destination_file_path)
+            for object_key, destination_file_path in zip(
+                object_keys, destination_file_paths)]
+        for future in futures:
+            future.result()
+    print(f'Downloaded {len(object_keys)} files from '
+          f's3://{s3_bucket_name}')
+
+
+def delete_unload_files(s3_connection, s3_bucket_name, s3_prefix,
+                        object_keys):
+    """
+    Delete the unloaded files and their manifest from S3 once they have been
+    downloaded, so every run doesn't leave a full copy of the results behind
+    in the bucket. delete_objects accepts at most 1000 keys per request.
+    """
+    object_keys = object_keys + [f'{s3_prefix}manifest']
+    for index in range(0, len(object_keys), 1000):
+        s3_connection.delete_objects(
+            Bucket=s3_bucket_name,
+            Delete={'Objects': [
+                {'Key': object_key}
+                for object_key in object_keys[index:index + 1000]]})
+    print(f'Deleted {len(object_keys)} unloaded files from '
+          f's3://{s3_bucket_name}/{s3_prefix}')
+
+
+def merge_unload_files(file_paths, destination_full_path,
+                       destination_file_format='csv', column_names=None,
+                       compression='none'):
+    """
+    Combine the downloaded files, in order, into a single file and remove
+    them. CSV files are concatenated byte for byte, which is valid for
+    gzip, bz2 and zstd streams too; the header, if any, is written once in
+    front of them. Parquet files are copied over one row group at a time.
+    """
+    if destination_file_format == 'parquet':
+        writer = None
+        try:
+            for file_path in file_paths:
+                parquet_file = pq.ParquetFile(file_path)
+                if not writer:
+                    schema = create_merged_schema(file_paths)
+                    writer = pq.ParquetWriter(destination_full_path, schema)
+                for row_group in range(parquet_file.num_row_groups):
+                    writer.write_table(cast_table(
+                        parquet_file.read_row_group(row_group), schema))
+        finally:
+            if writer:
+                writer.close()
+    else:
+        destination_file = open_destination_file(
+            destination_full_path, compression)
+        if column_names:
+            csv.writer(destination_file, lineterminator='\n').writerow(
+                column_names)
+        destination_file.close()
+        with open(destination_full_path, 'ab') as destination_file:
+            for file_path in file_paths:
+                with open(file_path, 'rb') as unload_file:
+                    shutil.copyfileobj(unload_file, destination_file, 1048576)
+
+    for file_path in file_paths:
+        os.remove(file_path)
+    print(f'Merged {len(file_paths)} files into {destination_full_path}.')
+
+
+def create_files_with_unload(query, db_connection, s3_connection,
+                             s3_bucket_name, s3_folder_name, iam_role,
+                             destination_full_path,
+                             destination_file_format='csv',
+                             compression='none', file_header=True,
+                             merge_files=True, max_workers=8,
+                             keep_unload_files=False):
+    """
+    Store the results of a query by having Redshift UNLOAD them to S3 in
+    parallel, then downloading the files concurrently. The files are merged
+    into destination_full_path when merge_files is set, otherwise they are
+    kept as numbered parts next to it. The unloaded files are removed from
+    S3 afterwards unless keep_unload_files is set. Every run unloads into
+    its own folder, so concurrent runs never overwrite each other's files.
+    """
+    s3_prefix = combine_folder_and_file_name(
+        combine_folder_and_file_name(
+            s3_folder_name, f'shipyard_{uuid.uuid4().hex}'),
+        f'{os.path.basename(destination_full_path)}_part_').lstrip('/')
+    object_keys = unload_query(
+        query=query, db_connection=db_connection, s3_connection=s3_connection,
+        s3_bucket_name=s3_bucket_name, s3_prefix=s3_prefix,
+        iam_role=iam_role, destination_file_format=destination_file_format,
+        compression=compression,
+        file_header=file_header and not merge_files)
+
+    destination_file_paths = [
+        enumerate_destination_file_name(destination_full_path, index + 1)
+        for index in range(len(object_keys))]
+    download_unload_files(
+        s3_connection=s3_connection, s3_bucket_name=s3_bucket_name,
+        object_keys=object_keys,
+        destination_file_paths=destination_file_paths,
+        max_workers=max_workers)
+
+    if merge_files:
+        column_names = None
+        if destination_file_format == 'csv' and file_header:
+            column_names = get_column_names(query, db_connection)
+        merge_unload_files(
+            file_paths=destination_file_paths,
+            destination_full_path=destination_full_path,
+            destination_file_format=destination_file_format,
+            column_names=column_names, compression=compression)
+
+    if not keep_unload_files:
+        delete_unload_files(
+            s3_connection=s3_connection, s3_bucket_name=s3_bucket_name,
+            s3_prefix=s3_prefix, object_keys=object_keys)
+
+
+def format_watermark(value):
+    """
+    Render a high-water mark as a SQL literal. Dates, timestamps and
+    strings are quoted so the database casts them back to the column's
+    type. Trailing zeros are dropped from fractional seconds, since some
+    timestamp types accept fewer than six digits. Any UTC offset is kept
+    as it is.
+    """
+    if isinstance(value, datetime.datetime):
+        timestamp = value.replace(tzinfo=None).isoformat(sep=' ')
+        utc_offset = value.isoformat(sep=' ')[len(timestamp):]
+        if '.' in timestamp:
+            timestamp = timestamp.rstrip('0').rstrip('.')
+        value = timestamp + utc_offset
+    if isinstance(value, (datetime.date, str)):
+        escaped_value = str(value).replace("'", "''")
+        return f"'{escaped_value}'"
+    return str(value)
+
+
+def create_state_key(query, incremental_column):
+    """
+    Key the stored high-water mark on the query and column it belongs to,
+    so several extracts can share one state file.
+    """
+    key = json.dumps([query.strip().rstrip(';'), incremental_column])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def read_incremental_state(incremental_state_file):
+    """
+    Read the high-water marks saved by previous runs.
+    """
+    if not os.path.exists(incremental_state_file):
+        return {}
+    with open(incremental_state_file, 'r') as state_file:
+        return json.load(state_file)
+
+
+def write_incremental_state(incremental_state, incremental_state_file):
+    """
+    Replace the state file in one step, so an interrupted run can't leave
+    it half written.
+    """
+    temporary_file_name = f'{incremental_state_file}.tmp'
+    with open(temporary_file_name, 'w') as state_file:
+        json.dump(incremental_state, state_file, indent=2)
+    os.replace(temporary_file_name, incremental_state_file)
+
+
+def get_upper_watermark(query, incremental_column, db_connection):
+    """
+    Find the current high-water mark of the column before extracting, so
+    this run has a fixed upper bound.
+    """
+    query = query.strip().rstrip(';')
+    with db_connection.connect() as connection:
+        value = connection.execute(text(
+            f'SELECT MAX({incremental_column}) '
+            f'FROM ({query}) AS incremental_source')).scalar()
+    return None if value is None else format_watermark(value)
+
+
+def create_incremental_query(query, incremental_column, lower_watermark,
+                             upper_watermark):
+    """
+    Limit the query to rows after the previous run's high-water mark, up to
+    the mark taken at the start of this run. Rows that arrive while the
+    extract runs are left for the next run rather than being split across
+    two of them.
+    """
+    query = query.strip().rstrip(';')
+    predicate = f'{incremental_column} <= {upper_watermark}'
+    if lower_watermark is not None:
+        predicate = f'{incremental_column} > {lower_watermark} AND {predicate}'
+    return f'SELECT * FROM ({query}) AS incremental_query WHERE {predicate}'
+
+
+def append_incremental_file(new_file_path, destination_full_path,
+                            destination_file_format='csv'):
+    """
+    Add the rows extracted by this run to the end of the existing output.
+    CSV files, compressed or not, are appended byte for byte, since only
+    the first run writes a header. Parquet can't be appended to in place,
+    so the existing row groups and the new ones are copied into a fresh
+    file that replaces the old one.
+    """
+    if not os.path.exists(new_file_path):
+        return
+    if not os.path.exists(destination_full_path):
+        os.replace(new_file_path, destination_full_path)
+        return
+
+    if destination_file_format == 'parquet':
+        merged_file_path = f'{destination_full_path}.tmp'
+        schema = create_merged_schema(
+            [destination_full_path, new_file_path])
+        writer = pq.ParquetWriter(merged_file_path, schema)
+        try:
+            for file_path in (destination_full_path, new_file_path):
+                parquet_file = pq.ParquetFile(file_path)
+                for row_group in range(parquet_file.num_row_groups):
+                    writer.write_table(cast_table(
+                        parquet_file.read_row_group(row_group), schema))
+        finally:
+            writer.close()
+        os.replace(merged_file_path, destination_full_path)
+    else:
+        with open(destination_full_path, 'ab') as destination_file:
+            with open(new_file_path, 'rb') as new_file:
+                shutil.copyfileobj(new_file, destination_file, 1048576)
+    os.remove(new_file_path)
+
+
 def main():
     args = get_args()
     username = args.username
@@ -78,7 +656,17 @@ def main():
     destination_full_path = combine_folder_and_file_name(
         folder_name=destination_folder_name, file_name=destination_file_name)
     file_header = convert_to_boolean(args.file_header)
+    destination_file_format = args.destination_file_format
+    parquet_compression = args.parquet_compression
+    compression = args.compression
+    row_group_size = int(args.row_group_size)
+    export_method = args.export_method
+    merge_files = convert_to_boolean(args.merge_files)
+    max_workers = int(args.max_workers)
+    keep_unload_files = convert_to_boolean(args.keep_unload_files)
     query = args.query
+    incremental_column = args.incremental_column
+    incremental_state_file = args.incremental_state_file
 
     try:
         db_string = f'postgresql://{username}:{password}@{host}:{port}/{database}?{url_parameters}'
@@ -92,10 +680,69 @@ def main():
             destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    create_csv(
-        query=query,
-        db_connection=db_connection,
-        destination_full_path=destination_full_path)
+    if destination_file_format == 'csv':
+        destination_full_path = add_compression_extension(
+            destination_full_path, compression)
+
+    if incremental_column:
+        incremental_state = read_incremental_state(incremental_state_file)
+        state_key = create_state_key(query, incremental_column)
+        lower_watermark = incremental_state.get(state_key)
+        upper_watermark = get_upper_watermark(
+            query, incremental_column, db_connection)
+        if upper_watermark is None or upper_watermark == lower_watermark:
+            print(f'No new rows since {incremental_column} reached '
+                  f'{lower_watermark}.')
+            return
+        query = create_incremental_query(
+            query, incremental_column, lower_watermark, upper_watermark)
+        # New rows are extracted to a side file, then appended to the
+        # existing output once the extract has succeeded.
+        output_full_path = destination_full_path
+        destination_full_path = f'{output_full_path}.incremental'
+        file_header = file_header and not os.path.exists(output_full_path)
+        # Separate part files can't be appended to the output.
+        merge_files = True
+
+    if export_method == 'unload':
+        set_environment_variables(args)
+        s3_connection = connect_to_s3(args.s3_endpoint_url)
+        create_files_with_unload(
+            query=query,
+            db_connection=db_connection,
+            s3_connection=s3_connection,
+            s3_bucket_name=args.s3_bucket_name,
+            s3_folder_name=args.s3_folder_name,
+            iam_role=args.iam_role,
+            destination_full_path=destination_full_path,
+            destination_file_format=destination_file_format,
+            compression=compression,
+            file_header=file_header,
+            merge_files=merge_files,
+            max_workers=max_workers,
+            keep_unload_files=keep_unload_files)
+    elif destination_file_format == 'parquet':
+        create_parquet(
+            query=query,
+            db_connection=db_connection,
+            destination_file_path=destination_full_path,
+            row_group_size=row_group_size,
+            compression=parquet_compression)
+    else:
+        create_csv(
+            query=query,
+            db_connection=db_connection,
+            destination_full_path=destination_full_path,
+            file_header=file_header,
+            compression=compression)
+
+    if incremental_column:
+        append_incremental_file(
+            destination_full_path, output_full_path, destination_file_format)
+        incremental_state[state_key] = upper_watermark
+        write_incremental_state(incremental_state, incremental_state_file)
+        print(f'Appended rows up to {incremental_column} {upper_watermark} '
+              f'to {output_full_path}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,412 @@
+from sqlalchemy import create_engine
+from sqlalchemy.types import VARCHAR
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import glob
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+import boto3
+import pandas as pd
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--username', dest='username', required=True)
+    parser.add_argument('--password', dest='password', required=False)
+    parser.add_argument('--host', dest='host', required=True)
+    parser.add_argument('--database', dest='database', required=True)
+    parser.add_argument('--port', dest='port', default='5439', required=False)
+    parser.add_argument('--url-parameters', dest='url_parameters',
+                        required=False)
+    parser.add_argument('--source-file-name-match-type',
+                        dest='source_file_name_match_type',
+                        choices={
+                            'exact_match',
+                            'regex_match'},
+                        required=True)
+    parser.add_argument('--source-file-name', dest='source_file_name',
+                        default='output.csv', required=True)
+    parser.add_argument('--source-folder-name',
+                        dest='source_folder_name', default='', required=False)
+    parser.add_argument('--table-name', dest='table_name', default=None,
+                        required=True)
+    parser.add_argument('--insert-method', dest='insert_method',
+                        choices={'fail', 'replace', 'append'},
+                        default='append', required=False)
+    parser.add_argument('--file-header', dest='file_header', default='True',
+                        required=False)
+    parser.add_argument('--delimiter', dest='delimiter', default=',',
+                        required=False)
+    parser.add_argument('--part-count', dest='part_count', default='',
+                        required=False)
+    parser.add_argument('--s3-bucket-name', dest='s3_bucket_name',
+                        required=True)
+    parser.add_argument('--s3-folder-name', dest='s3_folder_name', default='',
+                        required=False)
+    parser.add_argument('--iam-role', dest='iam_role', required=True)
+    parser.add_argument('--max-workers', dest='max_workers', default='8',
+                        required=False)
+    parser.add_argument('--vacuum', dest='vacuum', default='False',
+                        required=False)
+    parser.add_argument('--analyze', dest='analyze', default='False',
+                        required=False)
+    parser.add_argument('--s3-endpoint-url', dest='s3_endpoint_url',
+                        default=None, required=False)
+    parser.add_argument('--aws-access-key-id', dest='aws_access_key_id',
+                        required=False)
+    parser.add_argument('--aws-secret-access-key',
+                        dest='aws_secret_access_key', required=False)
+    parser.add_argument('--aws-default-region', dest='aws_default_region',
+                        required=False)
+    args = parser.parse_args()
+    return args
+
+
+def convert_to_boolean(string):
+    """
+    Shipyard can't support passing Booleans to code, so we have to convert
+    string values to their boolean values.
+    """
+    if string in ['True', 'true', 'TRUE']:
+        value = True
+    else:
+        value = False
+    return value
+
+
+def find_all_local_file_names(source_folder_name):
+    """
+    Returns a list of all files that exist in the current working directory,
+    filtered by source_folder_name if provided.
+    """
+    cwd = os.getcwd()
+    cwd_extension = os.path.normpath(f'{cwd}/{source_folder_name}/**')
+    file_names = glob.glob(cwd_extension, recursive=True)
+    return [file_name for file_name in file_names if os.path.isfile(file_name)]
+
+
+def find_all_file_matches(file_names, file_name_re):
+    """
+    Return a list of all file_names that matched the regular expression.
+    """
+    matching_file_names = []
+    for file in file_names:
+        if re.search(file_name_re, file):
+            matching_file_names.append(file)
+
+    return matching_file_names
+
+
+def combine_folder_and_file_name(folder_name, file_name):
+    """
+    Combine together the provided folder_name and file_name into one path variable.
+    """
+    combined_name = os.path.normpath(
+        f'{folder_name}{"/" if folder_name else ""}{file_name}')
+
+    return combined_name
+
+
+def set_environment_variables(args):
+    """
+    Set AWS credentials as environment variables if they're provided via keyword arguments
+    rather than seeded as environment variables. This will override system defaults.
+    """
+
+    if args.aws_access_key_id:
+        os.environ['AWS_ACCESS_KEY_ID'] = args.aws_access_key_id
+    if args.aws_secret_access_key:
+        os.environ['AWS_SECRET_ACCESS_KEY'] = args.aws_secret_access_key
+    if args.aws_default_region:
+        os.environ['AWS_DEFAULT_REGION'] = args.aws_default_region
+    return
+
+
+def connect_to_s3(s3_endpoint_url=None):
+    """
+    Create a connection to the S3 service using credentials provided as
+    environment variables. s3_endpoint_url points the client at an S3
+    compatible service instead of AWS.
+    """
+    s3_connection = boto3.client('s3', endpoint_url=s3_endpoint_url)
+    return s3_connection
+
+
+def print_throughput(row_count, start_time):
+    """
+    Print how many rows were loaded and how quickly.
+    """
+    elapsed_time = max(time.time() - start_time, 0.001)
+    print(
+        f'Loaded {row_count} rows in {elapsed_time:.2f} seconds '
+        f'({row_count / elapsed_time:.0f} rows/sec).')
+
+
+def get_slice_count(db_connection):
+    """
+    Return the number of slices in the cluster. COPY loads one file per
+    slice at a time, so splitting the data into this many parts keeps
+    every slice busy. Databases without stv_slices load into one part.
+    """
+    try:
+        with db_connection.connect() as connection:
+            return connection.execute(
+                'SELECT COUNT(*) FROM stv_slices').scalar() or 1
+    except Exception:
+        print('Could not read the slice count from stv_slices. '
+              'Loading a single part.')
+        return 1
+
+
+def read_file_header(source_full_path, delimiter=','):
+    """
+    Return the column names listed in the first line of the csv.
+    """
+    with open(source_full_path, 'r', newline='') as source_file:
+        return next(csv.reader(source_file, delimiter=delimiter))
+
+
+def split_files(matching_file_names, part_folder_name, part_count,
+                delimiter=',', file_header=True):
+    """
+    Spread the rows of every file across part_count gzip compressed csv
+    parts of roughly equal size, dropping the header of each file. Rows are
+    parsed and rewritten with the csv module, so quoted values containing
+    newlines stay intact. Returns the part file paths and the row count.
+    """
+    part_file_paths = [
+        os.path.join(part_folder_name, f'part_{index + 1}.csv.gz')
+        for index in range(part_count)]
+    part_files = [
+        io.TextIOWrapper(gzip.open(file_path, 'wb'), encoding='utf-8',
+                         newline='')
+        for file_path in part_file_paths]
+    writers = [csv.writer(part_file, delimiter=delimiter)
+               for part_file in part_files]
+
+    row_count = 0
+    try:
+        for file_name in matching_file_names:
+            with open(file_name, 'r', newline='') as source_file:
+                reader = csv.reader(source_file, delimiter=delimiter)
+                if file_header:
+                    next(reader, None)
+                for row in reader:
+                    writers[row_count % part_count].writerow(row)
+                    row_count += 1
+    finally:
+        for part_file in part_files:
+            part_file.close()
+    return part_file_paths, row_count
+
+
+def upload_parts(s3_connection, part_file_paths, s3_bucket_name, s3_prefix,
+                 max_workers=8):
+    """
+    Upload the part files to S3 several at a time and write the manifest
+    COPY reads them from. Returns the key of the manifest.
+    """
+    object_keys = [
+        f'{s3_prefix}{os.path.basename(file_path)}'
+        for file_path in part_file_paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(s3_connection.upload_file, file_path,
+                            s3_bucket_name, object_key)
+            for file_path, object_key in zip(part_file_paths, object_keys)]
+        for future in futures:
+            future.result()
+
+    manifest = {'entries': [
+        {'url': f's3://{s3_bucket_name}/{object_key}', 'mandatory': True,
+         'meta': {'content_length': os.path.getsize(file_path)}}
+        for file_path, object_key in zip(part_file_paths, object_keys)]}
+    manifest_key = f'{s3_prefix}manifest'
+    s3_connection.put_object(Bucket=s3_bucket_name, Key=manifest_key,
+                             Body=json.dumps(manifest).encode('utf-8'))
+    print(f'Uploaded {len(object_keys)} parts to '
+          f's3://{s3_bucket_name}/{s3_prefix}')
+    return manifest_key
+
+
+def delete_uploaded_files(s3_connection, s3_bucket_name, s3_prefix):
+    """
+    Remove the parts and manifest once they have been loaded.
+    """
+    response = s3_connection.list_objects_v2(
+        Bucket=s3_bucket_name, Prefix=s3_prefix)
+    objects = [{'Key': obj['Key']} for obj in response.get('Contents', [])]
+    if objects:
+        s3_connection.delete_objects(
+            Bucket=s3_bucket_name, Delete={'Objects': objects})
+
+
+def prepare_table(source_full_path, table_name, insert_method, connection,
+                  delimiter=',', file_header=True):
+    """
+    Make sure the target table exists before COPY runs, since COPY can't
+    create tables. Missing tables are created from the column types pandas
+    infers on a sample of the file, with text columns as VARCHAR(65535)
+    rather than Redshift's 256 character default. Runs inside the caller's
+    transaction, so a replaced table is only visible once the new data is
+    committed.
+    """
+    table_exists = connection.dialect.has_table(connection, table_name)
+    if table_exists and insert_method == 'fail':
+        raise ValueError(f'Table {table_name} already exists.')
+    if table_exists and insert_method == 'append':
+        return
+
+    sample = pd.read_csv(source_full_path, nrows=10000, sep=delimiter,
+                         header=0 if file_header else None)
+    if not file_header:
+        sample.columns = [
+            f'column_{index + 1}' for index in range(len(sample.columns))]
+    dtype = {column_name: VARCHAR(65535)
+             for column_name, column_type in sample.dtypes.items()
+             if column_type == object}
+    sample.head(0).to_sql(table_name, con=connection, index=False,
+                          if_exists='replace', dtype=dtype)
+
+
+def copy_from_manifest(table_name, column_names, s3_bucket_name,
+                       manifest_key, iam_role, connection, delimiter=','):
+    """
+    Load every part listed in the manifest with a single COPY.
+    """
+    escaped_delimiter = delimiter.replace("'", "''")
+    columns = ''
+    if column_names:
+        columns = '(' + ', '.join(
+            '"' + column_name.replace('"', '""') + '"'
+            for column_name in column_names) + ')'
+    connection.execute(
+        f"COPY {table_name} {columns} "
+        f"FROM 's3://{s3_bucket_name}/{manifest_key}' "
+        f"IAM_ROLE '{iam_role}' MANIFEST GZIP "
+        f"FORMAT AS CSV DELIMITER '{escaped_delimiter}' EMPTYASNULL")
+
+
+def maintain_table(table_name, db_connection, vacuum=False, analyze=False):
+    """
+    VACUUM and ANALYZE can't run inside a transaction, so they run on an
+    autocommit connection once the load has been committed.
+    """
+    with db_connection.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        if vacuum:
+            start_time = time.time()
+            connection.execute(f'VACUUM {table_name}')
+            print(f'Vacuumed {table_name} in '
+                  f'{time.time() - start_time:.2f} seconds.')
+        if analyze:
+            start_time = time.time()
+            connection.execute(f'ANALYZE {table_name}')
+            print(f'Analyzed {table_name} in '
+                  f'{time.time() - start_time:.2f} seconds.')
+
+
+def main():
+    args = get_args()
+    set_environment_variables(args)
+    username = args.username
+    password = args.password
+    host = args.host
+    database = args.database
+    port = args.port
+    url_parameters = args.url_parameters
+    source_file_name_match_type = args.source_file_name_match_type
+    source_file_name = args.source_file_name
+    source_folder_name = args.source_folder_name
+    source_full_path = combine_folder_and_file_name(
+        folder_name=source_folder_name, file_name=source_file_name)
+    table_name = args.table_name
+    insert_method = args.insert_method
+    file_header = convert_to_boolean(args.file_header)
+    delimiter = args.delimiter
+    s3_bucket_name = args.s3_bucket_name
+    s3_folder_name = args.s3_folder_name
+    iam_role = args.iam_role
+    max_workers = int(args.max_workers)
+    vacuum = convert_to_boolean(args.vacuum)
+    analyze = convert_to_boolean(args.analyze)
+
+    db_string = f'postgresql://{username}:{password}@{host}:{port}/{database}?{url_parameters}'
+    db_connection = create_engine(db_string)
+    s3_connection = connect_to_s3(args.s3_endpoint_url)
+
+    if source_file_name_match_type == 'regex_match':
+        file_names = find_all_local_file_names(source_folder_name)
+        matching_file_names = find_all_file_matches(
+            file_names, re.compile(source_file_name))
+        print(f'{len(matching_file_names)} files found. Preparing to upload...')
+    else:
+        matching_file_names = [source_full_path]
+
+    if not matching_file_names:
+        return
+
+    if args.part_count:
+        part_count = int(args.part_count)
+    else:
+        part_count = get_slice_count(db_connection)
+
+    column_names = None
+    if file_header:
+        column_names = read_file_header(matching_file_names[0], delimiter)
+
+    # Every run uploads under a new folder, so the manifest only ever lists
+    # the parts written by this run.
+    s3_prefix = combine_folder_and_file_name(
+        s3_folder_name, f'shipyard_{uuid.uuid4().hex}') + '/'
+    part_folder_name = tempfile.mkdtemp()
+    start_time = time.time()
+    try:
+        part_file_paths, row_count = split_files(
+            matching_file_names, part_folder_name, part_count, delimiter,
+            file_header)
+        print(f'Split {row_count} rows into {part_count} parts.')
+        manifest_key = upload_parts(
+            s3_connection, part_file_paths, s3_bucket_name, s3_prefix,
+            max_workers)
+    finally:
+        shutil.rmtree(part_folder_name)
+
+    try:
+        with db_connection.begin() as connection:
+            prepare_table(
+                source_full_path=matching_file_names[0],
+                table_name=table_name, insert_method=insert_method,
+                connection=connection, delimiter=delimiter,
+                file_header=file_header)
+            copy_from_manifest(
+                table_name=table_name, column_names=column_names,
+                s3_bucket_name=s3_bucket_name, manifest_key=manifest_key,
+                iam_role=iam_role, connection=connection,
+                delimiter=delimiter)
+    except Exception as e:
+        print(f'Failed to copy s3://{s3_bucket_name}/{manifest_key} '
+              f'into {table_name}')
+        raise(e)
+    finally:
+        delete_uploaded_files(s3_connection, s3_bucket_name, s3_prefix)
+
+    print_throughput(row_count, start_time)
+    print(f'{len(matching_file_names)} files have been uploaded to '
+          f'{table_name}.')
+
+    if vacuum or analyze:
+        maintain_table(table_name, db_connection, vacuum, analyze)
+
+
+if __name__ == '__main__':
+    main()
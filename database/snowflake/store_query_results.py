@@ -1,7 +1,18 @@
 import snowflake.connector
 import argparse
+import bz2
+import gzip
+import io
+import datetime
+import hashlib
+import json
+import shutil
 import os
+import time
 import pandas as pd
+import zstandard
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 def get_args():
@@ -18,6 +29,27 @@ def get_args():
             dest='destination_folder_name', default='', required=False)
     parser.add_argument('--file-header', dest='file_header', default='True',
             required=False)
+    parser.add_argument('--destination-file-format',
+            dest='destination_file_format',
+            choices={'csv', 'parquet'}, default='csv',
+            required=False)
+    parser.add_argument('--parquet-compression', dest='parquet_compression',
+            choices={'snappy', 'gzip', 'brotli', 'zstd', 'none'},
+            default='snappy', required=False)
+    parser.add_argument('--row-group-size', dest='row_group_size',
+            default='10000', required=False)
+    parser.add_argument('--compression', dest='compression',
+            choices={'none', 'gzip', 'zstd', 'bz2'},
+            default='none', required=False)
+    parser.add_argument('--export-method', dest='export_method',
+            choices={'pandas', 'arrow'}, default='pandas', required=False)
+    parser.add_argument('--prefetch-threads', dest='prefetch_threads',
+            default='4', required=False)
+    parser.add_argument('--incremental-column', dest='incremental_column',
+            default=None, required=False)
+    parser.add_argument('--incremental-state-file',
+            dest='incremental_state_file', default='incremental_state.json',
+            required=False)
     args = parser.parse_args()
     return args
 
@@ -44,22 +76,406 @@ def combine_folder_and_file_name(folder_name, file_name):
     return combined_name
 
 
-def create_csv(query, db_connection, destination_file_path, file_header=True):
+def add_compression_extension(destination_full_path, compression):
+    """
+    Add the file extension matching the compression method, unless the
+    provided file name already ends with it.
+    """
+    extension = {'gzip': '.gz', 'bz2': '.bz2', 'zstd': '.zst'}.get(compression)
+    if extension and not destination_full_path.endswith(extension):
+        destination_full_path = f'{destination_full_path}{extension}'
+    return destination_full_path
+
+
+def open_destination_file(destination_file_path, compression='none',
+                          buffer_size=8388608):
+    """
+    Open the destination file once for the whole extract, with a large write
+    buffer. Rows are compressed as they are written when a compression
+    method is provided, so the uncompressed file never touches disk. Any
+    file left behind by a previous run is truncated rather than appended to.
+    """
+    if compression == 'gzip':
+        binary_file = gzip.open(destination_file_path, 'wb')
+    elif compression == 'bz2':
+        binary_file = bz2.open(destination_file_path, 'wb')
+    elif compression == 'zstd':
+        # threads=-1 spreads compression across every available core.
+        binary_file = zstandard.ZstdCompressor(threads=-1).stream_writer(
+            open(destination_file_path, 'wb', buffering=buffer_size))
+    else:
+        binary_file = open(destination_file_path, 'wb', buffering=buffer_size)
+    return io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+
+
+def close_destination_file(destination_file, destination_file_path):
+    """
+    Close the destination file, writing out any buffered or compressed data,
+    and fsync it once every row has been written. Returns the number of
+    bytes written.
+    """
+    destination_file.close()
+    file_descriptor = os.open(destination_file_path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+    return os.path.getsize(destination_file_path)
+
+
+def create_csv(query, db_connection, destination_file_path, file_header=True,
+               compression='none'):
     """
     Read in data from a SQL query. Store the data as a csv.
     """
-    i = 1
-    for chunk in pd.read_sql_query(query, db_connection, chunksize=10000):
-        if i == 1:
-            chunk.to_csv(destination_file_path, mode='a',
-                         header=file_header, index=False)
-        else:
-            chunk.to_csv(destination_file_path, mode='a',
-                         header=False, index=False)
-        i += 1
+    row_count = 0
+    destination_file = open_destination_file(destination_file_path, compression)
+    try:
+        for chunk_number, chunk in enumerate(
+                pd.read_sql_query(query, db_connection, chunksize=10000)):
+            chunk.to_csv(destination_file, index=False,
+                         header=file_header if chunk_number == 0 else False)
+            row_count += len(chunk)
+    finally:
+        byte_count = close_destination_file(
+            destination_file, destination_file_path)
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows ({byte_count} bytes).')
+    return row_count, byte_count
+
+
+def promote_arrow_types(field_types):
+    """
+    Pick one type that values of every type in field_types can be stored as.
+    Nulls take the type of the other values, integers mixed with floats
+    become floats and decimals are widened to fit every precision and
+    scale. Any other mix is stored as strings. Columns with nothing but
+    nulls stay null, so a later chunk can still give them a real type.
+    """
+    field_types = [field_type for field_type in field_types
+                   if field_type != pa.null()]
+    if not field_types:
+        return pa.null()
+    if all(field_type == field_types[0] for field_type in field_types):
+        return field_types[0]
+    if all(pa.types.is_integer(field_type) for field_type in field_types):
+        return pa.int64()
+    if all(pa.types.is_integer(field_type) or pa.types.is_floating(field_type)
+           for field_type in field_types):
+        return pa.float64()
+    if all(pa.types.is_decimal(field_type) for field_type in field_types):
+        scale = max(field_type.scale for field_type in field_types)
+        integer_digits = max(field_type.precision - field_type.scale
+                             for field_type in field_types)
+        return pa.decimal128(min(integer_digits + scale, 38), scale)
+    return pa.string()
+
+
+def promote_schemas(schemas):
+    """
+    Build one schema that tables with every schema in schemas can be cast
+    to. Fields are kept in the order of the first schema.
+    """
+    field_types = [dict(zip(schema.names, schema.types))
+                   for schema in schemas]
+    return pa.schema([
+        pa.field(field_name, promote_arrow_types(
+            [types[field_name] for types in field_types
+             if field_name in types]))
+        for field_name in schemas[0].names])
+
+
+def create_merged_schema(file_paths):
+    """
+    Build one schema that every parquet file in file_paths can be cast to,
+    rather than assuming the types of the first file hold for all of them.
+    """
+    return promote_schemas(
+        [pq.read_schema(file_path) for file_path in file_paths])
+
+
+def cast_table(table, schema):
+    """
+    Cast every column of the table to the type in the schema. Columns that
+    Arrow can't cast directly are converted through their Python values.
+    """
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if column.type != field.type:
+            try:
+                column = column.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                values = column.to_pylist()
+                if field.type == pa.string():
+                    values = [None if value is None else str(value)
+                              for value in values]
+                column = pa.array(values, type=field.type)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def widen_parquet_file(writer, destination_file_path, schema, compression):
+    """
+    Rewrite the row groups already written to destination_file_path with
+    the wider schema, then return a writer that appends with that schema.
+    Parquet files have one schema, so this is the only way to widen a
+    column after its first row group.
+    """
+    writer.close()
+    previous_file_path = f'{destination_file_path}.tmp'
+    os.replace(destination_file_path, previous_file_path)
+    previous_file = pq.ParquetFile(previous_file_path)
+    writer = pq.ParquetWriter(destination_file_path, schema,
+                              compression=compression)
+    for row_group in range(previous_file.num_row_groups):
+        writer.write_table(cast_table(
+            previous_file.read_row_group(row_group), schema))
+    os.remove(previous_file_path)
+    return writer
+
+
+def write_parquet_chunk(writer, schema, table, destination_file_path,
+                        compression='snappy', row_group_size=10000):
+    """
+    Write one chunk of results to the parquet file, opening the writer on
+    the first chunk. The first chunk can't know every type, since a column
+    can be null or hold narrower decimals until later, so the schema is
+    widened whenever a chunk doesn't fit it. Returns the writer and the
+    schema to pass along with the next chunk.
+    """
+    if not writer:
+        schema = promote_schemas([table.schema])
+        writer = pq.ParquetWriter(destination_file_path, schema,
+                                  compression=compression)
+    else:
+        wider_schema = promote_schemas([schema, table.schema])
+        if not wider_schema.equals(schema):
+            schema = wider_schema
+            writer = widen_parquet_file(writer, destination_file_path,
+                                        schema, compression)
+    writer.write_table(cast_table(table, schema),
+                       row_group_size=row_group_size)
+    return writer, schema
+
+
+def create_parquet(query, db_connection, destination_file_path,
+                   row_group_size=10000, compression='snappy'):
+    """
+    Read in data from a SQL query. Store the data as a parquet file, writing
+    each chunk as its own row group so the full result is never held in
+    memory.
+    """
+    writer = None
+    schema = None
+    try:
+        for chunk in pd.read_sql_query(query, db_connection,
+                                       chunksize=row_group_size):
+            writer, schema = write_parquet_chunk(
+                writer, schema,
+                pa.Table.from_pandas(chunk, preserve_index=False),
+                destination_file_path, compression, row_group_size)
+    finally:
+        if writer:
+            writer.close()
+    print(f'{destination_file_path} was successfully created.')
     return
 
 
+def create_arrow_schema(schema):
+    """
+    Snowflake sizes integer columns per batch, so integers are stored as
+    int64 rather than widening the file each time a batch needs a larger
+    integer type.
+    """
+    return pa.schema([
+        pa.field(field.name, pa.int64())
+        if pa.types.is_integer(field.type) else field
+        for field in schema])
+
+
+def create_file_with_arrow(query, db_connection, destination_file_path,
+                           destination_file_format='csv', file_header=True,
+                           compression='none', parquet_compression='snappy'):
+    """
+    Read in data from a SQL query as the Arrow batches Snowflake produces,
+    which the connector downloads ahead of time on its prefetch threads.
+    Each batch is written straight to the csv or parquet file, and the time
+    spent waiting for each batch is reported separately from the time spent
+    writing it.
+    """
+    cursor = db_connection.cursor()
+    cursor.execute(query)
+    batches = cursor.fetch_arrow_batches()
+
+    row_count = 0
+    total_download_time = 0
+    total_write_time = 0
+    writer = None
+    schema = None
+    destination_file = None
+    if destination_file_format == 'csv':
+        destination_file = open_destination_file(
+            destination_file_path, compression)
+    try:
+        batch_number = 0
+        while True:
+            download_start_time = time.time()
+            batch = next(batches, None)
+            download_time = time.time() - download_start_time
+            if batch is None:
+                break
+
+            write_start_time = time.time()
+            if destination_file_format == 'parquet':
+                writer, schema = write_parquet_chunk(
+                    writer, schema,
+                    cast_table(batch, create_arrow_schema(batch.schema)),
+                    destination_file_path, parquet_compression,
+                    row_group_size=None)
+            else:
+                batch.to_pandas().to_csv(
+                    destination_file, index=False,
+                    header=file_header if batch_number == 0 else False)
+            write_time = time.time() - write_start_time
+
+            batch_number += 1
+            row_count += batch.num_rows
+            total_download_time += download_time
+            total_write_time += write_time
+            print(f'Batch {batch_number}: {batch.num_rows} rows, waited '
+                  f'{download_time:.2f}s for download, wrote in '
+                  f'{write_time:.2f}s.')
+    finally:
+        if writer:
+            writer.close()
+        if destination_file:
+            close_destination_file(destination_file, destination_file_path)
+        cursor.close()
+
+    print(f'{destination_file_path} was successfully created with '
+          f'{row_count} rows. Waited {total_download_time:.2f}s for downloads '
+          f'and spent {total_write_time:.2f}s writing.')
+    return row_count
+
+
+def format_watermark(value):
+    """
+    Render a high-water mark as a SQL literal. Dates, timestamps and
+    strings are quoted so the database casts them back to the column's
+    type. Trailing zeros are dropped from fractional seconds, since some
+    timestamp types accept fewer than six digits. Any UTC offset is kept
+    as it is.
+    """
+    if isinstance(value, datetime.datetime):
+        timestamp = value.replace(tzinfo=None).isoformat(sep=' ')
+        utc_offset = value.isoformat(sep=' ')[len(timestamp):]
+        if '.' in timestamp:
+            timestamp = timestamp.rstrip('0').rstrip('.')
+        value = timestamp + utc_offset
+    if isinstance(value, (datetime.date, str)):
+        escaped_value = str(value).replace("'", "''")
+        return f"'{escaped_value}'"
+    return str(value)
+
+
+def create_state_key(query, incremental_column):
+    """
+    Key the stored high-water mark on the query and column it belongs to,
+    so several extracts can share one state file.
+    """
+    key = json.dumps([query.strip().rstrip(';'), incremental_column])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def read_incremental_state(incremental_state_file):
+    """
+    Read the high-water marks saved by previous runs.
+    """
+    if not os.path.exists(incremental_state_file):
+        return {}
+    with open(incremental_state_file, 'r') as state_file:
+        return json.load(state_file)
+
+
+def write_incremental_state(incremental_state, incremental_state_file):
+    """
+    Replace the state file in one step, so an interrupted run can't leave
+    it half written.
+    """
+    temporary_file_name = f'{incremental_state_file}.tmp'
+    with open(temporary_file_name, 'w') as state_file:
+        json.dump(incremental_state, state_file, indent=2)
+    os.replace(temporary_file_name, incremental_state_file)
+
+
+def get_upper_watermark(query, incremental_column, db_connection):
+    """
+    Find the current high-water mark of the column before extracting, so
+    this run has a fixed upper bound.
+    """
+    query = query.strip().rstrip(';')
+    cursor = db_connection.cursor()
+    try:
+        cursor.execute(f'SELECT MAX({incremental_column}) '
+                       f'FROM ({query}) AS incremental_source')
+        value = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    return None if value is None else format_watermark(value)
+
+
+def create_incremental_query(query, incremental_column, lower_watermark,
+                             upper_watermark):
+    """
+    Limit the query to rows after the previous run's high-water mark, up to
+    the mark taken at the start of this run. Rows that arrive while the
+    extract runs are left for the next run rather than being split across
+    two of them.
+    """
+    query = query.strip().rstrip(';')
+    predicate = f'{incremental_column} <= {upper_watermark}'
+    if lower_watermark is not None:
+        predicate = f'{incremental_column} > {lower_watermark} AND {predicate}'
+    return f'SELECT * FROM ({query}) AS incremental_query WHERE {predicate}'
+
+
+def append_incremental_file(new_file_path, destination_full_path,
+                            destination_file_format='csv'):
+    """
+    Add the rows extracted by this run to the end of the existing output.
+    CSV files, compressed or not, are appended byte for byte, since only
+    the first run writes a header. Parquet can't be appended to in place,
+    so the existing row groups and the new ones are copied into a fresh
+    file that replaces the old one.
+    """
+    if not os.path.exists(new_file_path):
+        return
+    if not os.path.exists(destination_full_path):
+        os.replace(new_file_path, destination_full_path)
+        return
+
+    if destination_file_format == 'parquet':
+        merged_file_path = f'{destination_full_path}.tmp'
+        schema = create_merged_schema(
+            [destination_full_path, new_file_path])
+        writer = pq.ParquetWriter(merged_file_path, schema)
+        try:
+            for file_path in (destination_full_path, new_file_path):
+                parquet_file = pq.ParquetFile(file_path)
+                for row_group in range(parquet_file.num_row_groups):
+                    writer.write_table(cast_table(
+                        parquet_file.read_row_group(row_group), schema))
+        finally:
+            writer.close()
+        os.replace(merged_file_path, destination_full_path)
+    else:
+        with open(destination_full_path, 'ab') as destination_file:
+            with open(new_file_path, 'rb') as new_file:
+                shutil.copyfileobj(new_file, destination_file, 1048576)
+    os.remove(new_file_path)
+
+
 def main():
     args = get_args()
     username = args.username
@@ -67,15 +483,24 @@ def main():
     account = args.account
     database = args.database
     query = args.query
+    incremental_column = args.incremental_column
+    incremental_state_file = args.incremental_state_file
     destination_file_name = args.destination_file_name
     destination_folder_name = args.destination_folder_name
     destination_full_path = combine_folder_and_file_name(
         folder_name=destination_folder_name, file_name=destination_file_name)
     file_header = convert_to_boolean(args.file_header)
+    destination_file_format = args.destination_file_format
+    parquet_compression = args.parquet_compression
+    compression = args.compression
+    row_group_size = int(args.row_group_size)
+    export_method = args.export_method
+    prefetch_threads = int(args.prefetch_threads)
 
     try:
         con = snowflake.connector.connect(user=username, password=password,
-                                          account=account, database=database)
+                                          account=account, database=database,
+                                          client_prefetch_threads=prefetch_threads)
     except Exception as e:
         print(f'Failed to connect to Snowflake with user {username}')
 
@@ -83,11 +508,59 @@ def main():
             destination_folder_name != ''):
         os.makedirs(destination_folder_name)
 
-    create_csv(
-        query=query,
-        db_connection=con,
-        destination_file_path=destination_full_path,
-        file_header=file_header)
+    if destination_file_format == 'csv':
+        destination_full_path = add_compression_extension(
+            destination_full_path, compression)
+
+    if incremental_column:
+        incremental_state = read_incremental_state(incremental_state_file)
+        state_key = create_state_key(query, incremental_column)
+        lower_watermark = incremental_state.get(state_key)
+        upper_watermark = get_upper_watermark(
+            query, incremental_column, con)
+        if upper_watermark is None or upper_watermark == lower_watermark:
+            print(f'No new rows since {incremental_column} reached '
+                  f'{lower_watermark}.')
+            return
+        query = create_incremental_query(
+            query, incremental_column, lower_watermark, upper_watermark)
+        # New rows are extracted to a side file, then appended to the
+        # existing output once the extract has succeeded.
+        output_full_path = destination_full_path
+        destination_full_path = f'{output_full_path}.incremental'
+        file_header = file_header and not os.path.exists(output_full_path)
+
+    if export_method == 'arrow':
+        create_file_with_arrow(
+            query=query,
+            db_connection=con,
+            destination_file_path=destination_full_path,
+            destination_file_format=destination_file_format,
+            file_header=file_header,
+            compression=compression,
+            parquet_compression=parquet_compression)
+    elif destination_file_format == 'parquet':
+        create_parquet(
+            query=query,
+            db_connection=con,
+            destination_file_path=destination_full_path,
+            row_group_size=row_group_size,
+            compression=parquet_compression)
+    else:
+        create_csv(
+            query=query,
+            db_connection=con,
+            destination_file_path=destination_full_path,
+            file_header=file_header,
+            compression=compression)
+
+    if incremental_column:
+        append_incremental_file(
+            destination_full_path, output_full_path, destination_file_format)
+        incremental_state[state_key] = upper_watermark
+        write_incremental_state(incremental_state, incremental_state_file)
+        print(f'Appended rows up to {incremental_column} {upper_watermark} '
+              f'to {output_full_path}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,407 @@
+import snowflake.connector
+import argparse
+import os
+import glob
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--username', dest='username', required=True)
+    parser.add_argument('--password', dest='password', required=False)
+    parser.add_argument('--account', dest='account', required=True)
+    parser.add_argument('--database', dest='database', required=True)
+    parser.add_argument('--schema', dest='schema', required=False)
+    parser.add_argument('--warehouse', dest='warehouse', required=False)
+    parser.add_argument('--source-file-name-match-type',
+            dest='source_file_name_match_type',
+            choices={'exact_match', 'regex_match'}, required=True)
+    parser.add_argument('--source-file-name', dest='source_file_name',
+            default='output.csv', required=True)
+    parser.add_argument('--source-folder-name', dest='source_folder_name',
+            default='', required=False)
+    parser.add_argument('--table-name', dest='table_name', default=None,
+            required=True)
+    parser.add_argument('--insert-method', dest='insert_method',
+            choices={'fail', 'replace', 'append'}, default='append',
+            required=False)
+    parser.add_argument('--stage-name', dest='stage_name', default='',
+            required=False)
+    parser.add_argument('--max-workers', dest='max_workers', default='4',
+            required=False)
+    parser.add_argument('--put-parallel', dest='put_parallel', default='4',
+            required=False)
+    parser.add_argument('--delimiter', dest='delimiter', default=',',
+            required=False)
+    parser.add_argument('--quote-character', dest='quote_character',
+            default='"', required=False)
+    parser.add_argument('--file-header', dest='file_header', default='True',
+            required=False)
+    parser.add_argument('--on-error', dest='on_error',
+            choices={'abort_statement', 'continue', 'skip_file'},
+            default='abort_statement', required=False)
+    args = parser.parse_args()
+    return args
+
+
+SNOWFLAKE_TYPES = {
+    'i': 'NUMBER',
+    'u': 'NUMBER',
+    'f': 'FLOAT',
+    'b': 'BOOLEAN',
+    'M': 'TIMESTAMP_NTZ'}
+
+
+def convert_to_boolean(string):
+    """
+    Shipyard can't support passing Booleans to code, so we have to convert
+    string values to their boolean values.
+    """
+    if string in ['True', 'true', 'TRUE']:
+        value = True
+    else:
+        value = False
+    return value
+
+
+def find_all_local_file_names(source_folder_name):
+    """
+    Returns a list of all files that exist in the current working directory,
+    filtered by source_folder_name if provided.
+    """
+    cwd = os.getcwd()
+    cwd_extension = os.path.normpath(f'{cwd}/{source_folder_name}/**')
+    file_names = glob.glob(cwd_extension, recursive=True)
+    return [file_name for file_name in file_names if os.path.isfile(file_name)]
+
+
+def find_all_file_matches(file_names, file_name_re):
+    """
+    Return a list of all file_names that matched the regular expression.
+    """
+    matching_file_names = []
+    for file in file_names:
+        if re.search(file_name_re, file):
+            matching_file_names.append(file)
+
+    return matching_file_names
+
+
+def combine_folder_and_file_name(folder_name, file_name):
+    """
+    Combine together the provided folder_name and file_name into one path variable.
+    """
+    combined_name = os.path.normpath(
+        f'{folder_name}{"/" if folder_name else ""}{file_name}')
+
+    return combined_name
+
+
+def print_throughput(row_count, start_time):
+    """
+    Print how many rows were loaded and how quickly.
+    """
+    elapsed_time = max(time.time() - start_time, 0.001)
+    print(
+        f'Loaded {row_count} rows in {elapsed_time:.2f} seconds '
+        f'({row_count / elapsed_time:.0f} rows/sec).')
+
+
+def quote_string(value):
+    """
+    Render a value as a single quoted SQL string literal.
+    """
+    escaped_value = value.replace('\\', '\\\\').replace("'", "\\'")
+    return f"'{escaped_value}'"
+
+
+def table_exists(table_name, con):
+    """
+    Check whether the table exists in the current schema.
+    """
+    cursor = con.cursor()
+    try:
+        cursor.execute(
+            'SELECT COUNT(*) FROM information_schema.tables '
+            'WHERE table_schema = CURRENT_SCHEMA() '
+            'AND table_name = UPPER(%s)', (table_name,))
+        return cursor.fetchone()[0] > 0
+    finally:
+        cursor.close()
+
+
+def format_column_name(column_name):
+    """
+    Leave simple column names unquoted, so Snowflake stores them upper
+    cased and they can be used without quotes in later SQL. Names that
+    can't be written as plain identifiers are quoted as they are.
+    """
+    column_name = str(column_name)
+    if re.match(r'^[A-Za-z_][A-Za-z0-9_$]*$', column_name):
+        return column_name.upper()
+    escaped_column_name = column_name.replace('"', '""')
+    return f'"{escaped_column_name}"'
+
+
+def create_table_from_sample(source_full_path, table_name, con,
+                             delimiter=',', quote_character='"',
+                             file_header=True):
+    """
+    Create the table from the column types pandas infers on a sample of the
+    file, since COPY INTO can only load into a table that already exists.
+    """
+    sample = pd.read_csv(source_full_path, nrows=10000, sep=delimiter,
+                         quotechar=quote_character,
+                         header=0 if file_header else None)
+    columns = []
+    for index, (column_name, dtype) in enumerate(sample.dtypes.items()):
+        if not file_header:
+            column_name = f'column_{index + 1}'
+        column_type = SNOWFLAKE_TYPES.get(dtype.kind, 'VARCHAR')
+        columns.append(f'{format_column_name(column_name)} {column_type}')
+
+    cursor = con.cursor()
+    try:
+        cursor.execute(
+            f'CREATE TABLE {table_name} ({", ".join(columns)})')
+    finally:
+        cursor.close()
+
+
+def prepare_table(source_full_path, table_name, insert_method, con,
+                  delimiter=',', quote_character='"', file_header=True):
+    """
+    Create or check the table once, before any data is loaded, and return
+    the name of the table that every file should be loaded into. With
+    insert_method=replace the data goes into a fresh staging table that is
+    swapped in once everything has loaded, so the existing table stays
+    readable and complete until then. The staging table gets a random
+    suffix, so it can't collide with a user's table or another run.
+    """
+    exists = table_exists(table_name, con)
+    if exists and insert_method == 'fail':
+        raise ValueError(f'Table {table_name} already exists.')
+    if exists and insert_method == 'append':
+        return table_name
+
+    load_table_name = table_name
+    if insert_method == 'replace':
+        load_table_name = f'{table_name}_staging_{uuid.uuid4().hex}'
+    create_table_from_sample(source_full_path, load_table_name, con,
+                             delimiter, quote_character, file_header)
+    return load_table_name
+
+
+def swap_staging_table(staging_table_name, table_name, con):
+    """
+    Atomically replace table_name with the fully loaded staging table.
+    SWAP WITH exchanges both tables in a single operation, so readers see
+    either the old table or the new one, never a partial load.
+    """
+    exists = table_exists(table_name, con)
+    cursor = con.cursor()
+    try:
+        if exists:
+            cursor.execute(
+                f'ALTER TABLE {staging_table_name} SWAP WITH {table_name}')
+            cursor.execute(f'DROP TABLE {staging_table_name}')
+        else:
+            cursor.execute(
+                f'ALTER TABLE {staging_table_name} RENAME TO {table_name}')
+    finally:
+        cursor.close()
+    print(f'Swapped {staging_table_name} in as {table_name}.')
+
+
+def drop_staging_table(staging_table_name, con):
+    """
+    Drop the staging table if it's still there. After a successful swap it
+    has already been dropped or renamed, so this only removes what a failed
+    load left behind.
+    """
+    cursor = con.cursor()
+    try:
+        cursor.execute(f'DROP TABLE IF EXISTS {staging_table_name}')
+    finally:
+        cursor.close()
+
+
+def remove_staged_files(stage_location, con):
+    """
+    Remove every file under the stage location. COPY INTO purges the files
+    it loads, so this only removes files left behind by a failed load.
+    """
+    cursor = con.cursor()
+    try:
+        cursor.execute(f'REMOVE {stage_location}')
+    finally:
+        cursor.close()
+
+
+def put_file(source_full_path, stage_location, con, put_parallel=4):
+    """
+    Compress a file and upload it to the stage with PUT. Each file gets its
+    own cursor, so several files can be uploaded at once.
+    """
+    file_url = 'file://' + os.path.abspath(source_full_path).replace('\\', '/')
+    cursor = con.cursor()
+    try:
+        cursor.execute(
+            f'PUT {quote_string(file_url)} {stage_location} '
+            f'AUTO_COMPRESS=TRUE OVERWRITE=TRUE PARALLEL={put_parallel}')
+        column_names = [column[0].lower() for column in cursor.description]
+        results = [dict(zip(column_names, row)) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    for result in results:
+        print(f'{source_full_path} was {result["status"].lower()} to '
+              f'{stage_location}/{result["target"]} '
+              f'({result["source_size"]} bytes, '
+              f'{result["target_size"]} bytes compressed).')
+    return results
+
+
+def put_files(matching_file_names, stage_location, con, max_workers=4,
+              put_parallel=4):
+    """
+    Upload every file to the stage, several at a time. Each file goes in
+    its own numbered folder, so files that share a name in different local
+    folders don't overwrite each other.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(put_file, file_name,
+                            f'{stage_location}/{index + 1}', con,
+                            put_parallel)
+            for index, file_name in enumerate(matching_file_names)]
+        for future in futures:
+            future.result()
+
+
+def copy_into_table(stage_location, table_name, con, delimiter=',',
+                    quote_character='"', file_header=True,
+                    on_error='abort_statement'):
+    """
+    Load every file under the stage location with a single COPY INTO, which
+    Snowflake spreads across the warehouse. The staged files are removed
+    once they have loaded. Returns the number of rows loaded.
+    """
+    file_format = (
+        'TYPE = CSV '
+        f'FIELD_DELIMITER = {quote_string(delimiter)} '
+        f'FIELD_OPTIONALLY_ENCLOSED_BY = {quote_string(quote_character)} '
+        f'SKIP_HEADER = {1 if file_header else 0} '
+        'EMPTY_FIELD_AS_NULL = TRUE')
+    cursor = con.cursor()
+    try:
+        cursor.execute(
+            f'COPY INTO {table_name} FROM {stage_location} '
+            f'FILE_FORMAT = ({file_format}) '
+            f'ON_ERROR = {on_error.upper()} PURGE = TRUE')
+        column_names = [column[0].lower() for column in cursor.description]
+        results = [dict(zip(column_names, row)) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+    row_count = 0
+    for result in results:
+        if 'rows_loaded' not in result:
+            print(list(result.values())[0])
+            continue
+        print(f'{result["file"]}: {result["status"]}, '
+              f'{result["rows_loaded"]} of {result["rows_parsed"]} rows loaded, '
+              f'{result["errors_seen"]} errors.')
+        if result['first_error']:
+            print(f'First error on line {result["first_error_line"]}: '
+                  f'{result["first_error"]}')
+        row_count += result['rows_loaded'] or 0
+    return row_count
+
+
+def main():
+    args = get_args()
+    username = args.username
+    password = args.password
+    account = args.account
+    database = args.database
+    schema = args.schema
+    warehouse = args.warehouse
+    source_file_name_match_type = args.source_file_name_match_type
+    source_file_name = args.source_file_name
+    source_folder_name = args.source_folder_name
+    source_full_path = combine_folder_and_file_name(
+        folder_name=source_folder_name, file_name=source_file_name)
+    table_name = args.table_name
+    insert_method = args.insert_method
+    stage_name = args.stage_name
+    max_workers = int(args.max_workers)
+    put_parallel = int(args.put_parallel)
+    delimiter = args.delimiter
+    quote_character = args.quote_character
+    file_header = convert_to_boolean(args.file_header)
+    on_error = args.on_error
+
+    try:
+        con = snowflake.connector.connect(user=username, password=password,
+                                          account=account, database=database,
+                                          schema=schema, warehouse=warehouse)
+    except Exception as e:
+        print(f'Failed to connect to Snowflake with user {username}')
+        raise(e)
+
+    if source_file_name_match_type == 'regex_match':
+        file_names = find_all_local_file_names(source_folder_name)
+        matching_file_names = find_all_file_matches(
+            file_names, re.compile(source_file_name))
+        print(f'{len(matching_file_names)} files found. Preparing to upload...')
+    else:
+        matching_file_names = [source_full_path]
+
+    if not matching_file_names:
+        return
+
+    load_table_name = prepare_table(
+        source_full_path=matching_file_names[0], table_name=table_name,
+        insert_method=insert_method, con=con, delimiter=delimiter,
+        quote_character=quote_character, file_header=file_header)
+
+    # Every run stages its files under a new folder, so COPY INTO only
+    # picks up the files uploaded by this run.
+    stage_folder_name = f'shipyard_{uuid.uuid4().hex}'
+    if stage_name:
+        stage_location = f'@{stage_name}/{stage_folder_name}'
+    else:
+        stage_location = f'@%{load_table_name}/{stage_folder_name}'
+
+    start_time = time.time()
+    try:
+        put_files(matching_file_names, stage_location, con,
+                  max_workers=max_workers, put_parallel=put_parallel)
+        row_count = copy_into_table(
+            stage_location=stage_location, table_name=load_table_name,
+            con=con, delimiter=delimiter, quote_character=quote_character,
+            file_header=file_header, on_error=on_error)
+        print_throughput(row_count, start_time)
+        print(f'{len(matching_file_names)} files have been uploaded to '
+              f'{table_name}.')
+
+        if load_table_name != table_name:
+            swap_staging_table(
+                staging_table_name=load_table_name, table_name=table_name,
+                con=con)
+    finally:
+        # A staging table's own stage is dropped along with the table.
+        if stage_name or load_table_name == table_name:
+            remove_staged_files(stage_location, con)
+        if load_table_name != table_name:
+            drop_staging_table(load_table_name, con)
+
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
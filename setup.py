@@ -17,6 +17,9 @@ config = {
     "author_email": "tech@shipyardapp.com",
     "packages": find_packages(),
     "install_requires": install_requires,
+    "extras_require": {
+        "turbodbc": ["turbodbc==4.1.0"],
+    },
     "name": "shipyard_starter_blueprints",
     "license": "Apache-2.0",
     "classifiers": [
@@ -0,0 +1,76 @@
+import decimal
+import importlib
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('zstandard')
+
+
+@pytest.fixture(params=['postgres', 'mysql', 'redshift'])
+def store_query_results(request):
+    return importlib.import_module(
+        f'database.{request.param}.store_query_results')
+
+
+def write_chunks(store_query_results, chunks, destination_file_path):
+    writer = None
+    schema = None
+    try:
+        for chunk in chunks:
+            writer, schema = store_query_results.write_parquet_chunk(
+                writer, schema,
+                pa.Table.from_pandas(chunk, preserve_index=False),
+                destination_file_path, row_group_size=2)
+    finally:
+        if writer:
+            writer.close()
+    return pq.read_table(destination_file_path)
+
+
+def test_later_chunk_with_wider_decimals(store_query_results, tmp_path):
+    chunks = [
+        pd.DataFrame({'amount': [decimal.Decimal('1.50'),
+                                 decimal.Decimal('22.75')]}),
+        pd.DataFrame({'amount': [decimal.Decimal('123456.125')]}),
+    ]
+    table = write_chunks(store_query_results, chunks,
+                         str(tmp_path / 'output.parquet'))
+    assert table.schema.field('amount').type == pa.decimal128(9, 3)
+    assert table.column('amount').to_pylist() == [
+        decimal.Decimal('1.500'), decimal.Decimal('22.750'),
+        decimal.Decimal('123456.125')]
+
+
+def test_later_chunk_fills_leading_null_column(store_query_results,
+                                               tmp_path):
+    chunks = [
+        pd.DataFrame({'id': [1, 2], 'value': [None, None]}),
+        pd.DataFrame({'id': [3], 'value': [7]}),
+    ]
+    table = write_chunks(store_query_results, chunks,
+                         str(tmp_path / 'output.parquet'))
+    assert table.schema.field('value').type == pa.int64()
+    assert table.column('id').to_pylist() == [1, 2, 3]
+    assert table.column('value').to_pylist() == [None, None, 7]
+
+
+def test_create_parquet_widens_between_chunks(tmp_path):
+    sqlalchemy = pytest.importorskip('sqlalchemy')
+    store_query_results = importlib.import_module(
+        'database.postgres.store_query_results')
+    engine = sqlalchemy.create_engine('sqlite://')
+    with engine.connect() as db_connection:
+        db_connection.execute(
+            sqlalchemy.text('CREATE TABLE items (id INTEGER, note TEXT)'))
+        db_connection.execute(sqlalchemy.text(
+            "INSERT INTO items VALUES (1, NULL), (2, NULL), (3, 'third')"))
+        destination_file_path = str(tmp_path / 'output.parquet')
+        store_query_results.create_parquet(
+            'SELECT id, note FROM items ORDER BY id', db_connection,
+            destination_file_path, row_group_size=2)
+    table = pq.read_table(destination_file_path)
+    assert table.column('note').to_pylist() == [None, None, 'third']
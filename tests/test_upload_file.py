@@ -0,0 +1,55 @@
+import importlib
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('sqlalchemy')
+
+
+@pytest.fixture(params=['mysql', 'mssql'])
+def upload_file(request):
+    return importlib.import_module(f'database.{request.param}.upload_file')
+
+
+def test_stray_quote_stays_in_its_chunk(upload_file, tmp_path):
+    source_full_path = tmp_path / 'input.csv'
+    source_full_path.write_bytes(
+        b'id,name\n'
+        b'1,12" ruler\n'
+        b'2,"tape, measuring"\n'
+        b'3,"multi\nline"\n'
+        b'4,"say ""hi"""\n'
+        b'5,pencil\n')
+    chunks = list(upload_file.read_chunks(str(source_full_path),
+                                          chunk_size=1))
+    assert [len(chunk) for chunk, _ in chunks] == [1, 1, 1, 1, 1]
+    assert [chunk['name'][0] for chunk, _ in chunks] == [
+        '12" ruler', 'tape, measuring', 'multi\nline', 'say "hi"', 'pencil']
+    assert chunks[-1][1] == source_full_path.stat().st_size
+
+
+@pytest.mark.parametrize('line, in_quotes, expected', [
+    (b'1,12" ruler\n', False, False),
+    (b'1,"open\n', False, True),
+    (b'still open\n', True, True),
+    (b'closed",2\n', True, False),
+    (b'1,"a ""quoted"" word\n', False, True),
+    (b'1,"done ""twice"""\n', False, False),
+])
+def test_ends_inside_quotes(upload_file, line, in_quotes, expected):
+    assert upload_file.ends_inside_quotes(line, in_quotes) == expected
+
+
+def test_postgres_column_types_fall_back_to_text():
+    pytest.importorskip('psycopg2')
+    upload_file = importlib.import_module('database.postgres.upload_file')
+    sample = pd.DataFrame({
+        'id': ['1', '2', '-3'],
+        'price': ['1.5', '2', '1e3'],
+        'active': ['true', 'False', None],
+        'note': [None, None, None],
+        'code': ['007', 'A12', '3'],
+    })
+    assert upload_file.infer_column_types(sample) == {
+        'id': 'BIGINT', 'price': 'NUMERIC', 'active': 'BOOLEAN',
+        'note': 'TEXT', 'code': 'TEXT'}